@@ -0,0 +1,646 @@
+"""
+Performance benchmarks for Pixel Knight.
+
+Everything runs headless through run.create_game(headless=True), so no
+window or audio device is needed. Run frames and startup from the
+directory that holds the resources folder, like run.py. micro generates
+everything it loads and runs anywhere.
+
+    python benchmark.py frames [--ticks N] [--replay FILE] [--json FILE]
+                               [--baseline FILE] [--threshold 0.10]
+    python benchmark.py micro [--frames N ...] [--sprites N ...]
+                              [--level-sizes WxH ...] [--json FILE]
+    python benchmark.py startup [--json FILE]
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import wave
+import pygame
+from pygame.locals import *
+
+import run
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LEVELS = ["level_101.png", "level_102.png", "level_103.png",
+          "level_104.png", "level_105.png", "level_106.png"]
+
+# the sprite sheets the micro benchmarks' entities and camera load, with
+# the number of frames in each, stood in for by generated sheets
+SYNTHETIC_SHEETS = {
+    "resources/images/entities/player_idle.png": 4,
+    "resources/images/entities/player_walking.png": 8,
+    "resources/images/entities/player_jumping.png": 1,
+    "resources/images/entities/player_falling.png": 1,
+    "resources/images/entities/player_attacking_high.png": 3,
+    "resources/images/entities/player_attacking_low.png": 3,
+    "resources/images/entities/player_death.png": 6,
+    "resources/images/entities/snake_idle.png": 2,
+    "resources/images/entities/rat_idle.png": 1,
+    "resources/images/entities/coin.png": 9,
+    os.path.join("resources/images/gui", "health.png"): 14}
+SYNTHETIC_IMAGES = ([os.path.join("resources/images/gui", "key.png"),
+                     os.path.join("resources/images/misc", "vignette.png")] +
+                    [os.path.join("resources/images/tiles", name) for name in run.TILE_NAMES[1:]])
+SYNTHETIC_SOUNDS = (['resources/sounds/entities/player/footstep%02d.ogg' % i for i in range(10)] +
+                    ['resources/sounds/entities/player/attack1.wav',
+                     'resources/sounds/entities/player/hit.wav',
+                     "resources/sounds/entities/enemies/hit.wav",
+                     "resources/sounds/entities/enemies/snake_death.ogg",
+                     "resources/sounds/entities/enemies/rat_death.ogg",
+                     "resources/sounds/entities/items/coin.wav"])
+
+
+def percentile(values, fraction):
+    # nearest-rank percentile of an unsorted list
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def summarize(seconds):
+    """p50/p95/p99/max and mean of a list of durations, in milliseconds."""
+    ms = [i * 1000 for i in seconds]
+    return {'p50': percentile(ms, 0.50),
+            'p95': percentile(ms, 0.95),
+            'p99': percentile(ms, 0.99),
+            'max': max(ms) if ms else 0.0,
+            'mean': sum(ms) / len(ms) if ms else 0.0}
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+class ScriptedInput(object):
+    """
+    A repeatable stand-in for a player: walks back and forth, jumps and
+    attacks on a fixed schedule. It never jumps in front of a door so the
+    run stays in the level being measured.
+    """
+    finished = False
+
+    def __init__(self):
+        self.tick = 0
+
+    def poll(self, events):
+        t = self.tick
+        self.tick += 1
+        keys = 0
+        if (t // 120) % 3 != 2:
+            keys |= run.INPUT_BITS[K_d]
+        else:
+            keys |= run.INPUT_BITS[K_a]
+        player = run.game.state.player
+        if t % 45 == 0 and not pygame.sprite.spritecollideany(player, player.doors):
+            keys |= run.INPUT_BITS[K_w]
+        if t % 30 == 5:
+            keys |= run.INPUT_BITS[K_SPACE]
+        return run.InputFrame(keys)
+
+
+class LoopedReplay(object):
+    """Plays a recording's input steps over and over, ignoring its start state."""
+    finished = False
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.tick = 0
+
+    def poll(self, events):
+        frame = self.frames[self.tick % len(self.frames)]
+        self.tick += 1
+        return frame
+
+
+def level_spawn(level, level_number):
+    # level 1 starts where a new game does, every other level is
+    # entered through a door
+    if level_number == 1 or not level.doors:
+        return None
+    return level.doors.sprites()[0].rect.center
+
+
+def enter_level(level_number, seed):
+    """Build a fresh GamePlay state and put the player in a level."""
+    run.rng.seed(seed)
+    run.sim_clock.reset()
+    state = run.GamePlay()
+    run.game.states["GAMEPLAY"] = state
+    run.game.state = state
+    run.game.state_name = "GAMEPLAY"
+    run.game.done = False
+    run.game.cutscene.reset()
+    spawn = level_spawn(state.levels.get(level_number), level_number)
+    if spawn:
+        state.change_level(level_number, spawn)
+    return state
+
+
+def bench_level(level_number, ticks, seed, frames=None):
+    """
+    Drive one level for a number of ticks and time the update and draw
+    half of every step separately.
+    """
+    game = run.game
+    state = enter_level(level_number, seed)
+    game.input = LoopedReplay(frames) if frames else ScriptedInput()
+    update_times = []
+    draw_times = []
+    clock = time.perf_counter
+    start = clock()
+    for _ in range(ticks):
+        t0 = clock()
+        game.event_loop()
+        game.update(run.TIMESTEP)
+        t1 = clock()
+        game.alpha = 1.0
+        game.draw()
+        t2 = clock()
+        update_times.append(t1 - t0)
+        draw_times.append(t2 - t1)
+    elapsed = clock() - start
+    return {'ticks': ticks,
+            'ticks_per_second': ticks / elapsed if elapsed > 0 else 0.0,
+            'update_ms': summarize(update_times),
+            'draw_ms': summarize(draw_times),
+            'frame_ms': summarize([u + d for u, d in zip(update_times, draw_times)]),
+            'final_level': state.current_level_number,
+            'checksum': '%08x' % state.checksum()}
+
+
+def compare(results, baseline, threshold):
+    """
+    Return a list of regressions against a baseline result: frame time
+    percentiles that grew, or throughput that fell, by more than threshold.
+    """
+    regressions = []
+    for name, current in results['levels'].items():
+        previous = baseline.get('levels', {}).get(name)
+        if not previous:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            old = previous['frame_ms'][key]
+            new = current['frame_ms'][key]
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append('%s frame %s %.3f ms -> %.3f ms (+%.0f%%)' % (name, key, old, new, (new / old - 1) * 100))
+        old = previous['ticks_per_second']
+        new = current['ticks_per_second']
+        if old > 0 and new < old * (1 - threshold):
+            regressions.append('%s ticks/second %.1f -> %.1f (-%.0f%%)' % (name, old, new, (1 - new / old) * 100))
+    return regressions
+
+
+def write_json(results, path):
+    if path == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def frames_command(args):
+    run.create_game(headless=True, start_state="GAMEPLAY", seed=args.seed)
+    frames = run.read_replay(args.replay)[2] if args.replay else None
+    results = {'benchmark': 'frames', 'seed': args.seed, 'ticks': args.ticks,
+               'input': args.replay or 'scripted', 'levels': {}}
+    for name in args.levels:
+        level_number = LEVELS.index(name) + 1
+        result = bench_level(level_number, args.ticks, args.seed, frames)
+        results['levels'][name] = result
+        print('%-14s %8.1f ticks/s   frame p50 %6.3f  p95 %6.3f  p99 %6.3f  max %7.3f ms' % (
+            name, result['ticks_per_second'], result['frame_ms']['p50'], result['frame_ms']['p95'],
+            result['frame_ms']['p99'], result['frame_ms']['max']), file=sys.stderr)
+    results['peak_rss_kb'] = peak_rss_kb()
+    if args.json:
+        write_json(results, args.json)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print('REGRESSION ' + line, file=sys.stderr)
+        if regressions:
+            return 1
+        print('no regressions against %s' % args.baseline, file=sys.stderr)
+    return 0
+
+
+def init_headless():
+    """Bring up pygame on the dummy drivers without building any game states."""
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    pygame.display.set_mode(run.SCREEN_SIZE.size)
+
+
+def timed(func, number):
+    """Average seconds per call of func over number calls."""
+    clock = time.perf_counter
+    start = clock()
+    for _ in range(number):
+        func()
+    return (clock() - start) / number
+
+
+def level_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def sheet_surface(frames):
+    # a single column sprite sheet with one 48x48 frame per row
+    sheet = pygame.Surface((48, 48 * frames))
+    sheet.fill((63, 114, 107))
+    for i in range(frames):
+        pygame.draw.rect(sheet, (200, 40 + i % 200, 40), (8, 48 * i + 8, 32, 32))
+    return sheet
+
+
+def make_sheet(path, frames):
+    pygame.image.save(sheet_surface(frames), path)
+
+
+def png_bytes(surface):
+    data = io.BytesIO()
+    pygame.image.save(surface, data, 'image.png')
+    return data.getvalue()
+
+
+def silence_bytes(seconds=0.05, rate=22050):
+    data = io.BytesIO()
+    with wave.open(data, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(bytes(int(seconds * rate) * 2))
+    return data.getvalue()
+
+
+def provide_resources():
+    """
+    Serve generated stand-ins from memory for the images, sounds and font
+    the micro benchmarks load, so they run without the resources folder.
+    """
+    for path, frames in SYNTHETIC_SHEETS.items():
+        run.assets.provide(path, png_bytes(sheet_surface(frames)))
+    tile = pygame.Surface((16, 16), SRCALPHA)
+    tile.fill((120, 120, 120, 255))
+    pygame.draw.rect(tile, (90, 90, 90, 255), (0, 0, 16, 16), 1)
+    for path in SYNTHETIC_IMAGES:
+        run.assets.provide(path, png_bytes(tile))
+    silence = silence_bytes()
+    for path in SYNTHETIC_SOUNDS:
+        run.assets.provide(path, silence)
+    with open(os.path.join(os.path.dirname(pygame.__file__), pygame.font.get_default_font()), 'rb') as f:
+        run.assets.provide(os.path.join("resources/font", "boxy_bold.ttf"), f.read())
+
+
+def make_level(path, width, height, entities, rnd):
+    """
+    Write a synthetic level image: a floor, walls, scattered half-height
+    platforms and a number of coins, snakes and rats.
+    """
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    pixel = image.load()
+    for i in range(width):
+        pixel[i, height - 1] = (0, 0, 0)
+        pixel[i, height - 2] = (0, 0, 0)
+    for j in range(height):
+        pixel[0, j] = (0, 0, 0)
+        pixel[width - 1, j] = (0, 0, 0)
+    for _ in range(width * height // 40):
+        i = rnd.randrange(1, max(2, width - 5))
+        j = rnd.randrange(1, max(2, height - 4))
+        for k in range(4):
+            pixel[min(i + k, width - 2), j] = (20, 20, 20)
+    spawns = [(255, 216, 0), (255, 216, 0), (255, 128, 0), (128, 64, 0)]
+    for _ in range(entities):
+        i = rnd.randrange(1, width - 1)
+        j = rnd.randrange(1, height - 2)
+        if pixel[i, j] == (255, 255, 255):
+            pixel[i, j] = rnd.choice(spawns)
+    image.save(path)
+
+
+def make_layer(path, width, height, rnd, fill=0.5):
+    # a tile layer with about fill of its tiles filled
+    keys = [key for key in run.TILE_DICT if len(key) == 4]
+    image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    pixel = image.load()
+    for i in range(width):
+        for j in range(height):
+            if rnd.random() < fill:
+                pixel[i, j] = rnd.choice(keys)
+    image.save(path)
+
+
+def make_level_files(workdir, name, width, height, entities, rnd):
+    """
+    Write a synthetic level with its own background and foreground layer
+    images, laid out the way run.level_sources looks for them.
+    """
+    path = os.path.join(workdir, name)
+    make_level(path, width, height, entities, rnd)
+    for layer, fill in (('background', 0.9), ('foreground', 0.3)):
+        os.makedirs(os.path.join(workdir, layer), exist_ok=True)
+        make_layer(os.path.join(workdir, layer, name), width, height, rnd, fill)
+    return path
+
+
+def micro_animation(results, frame_counts, number, workdir):
+    for frames in frame_counts:
+        path = os.path.join(workdir, 'sheet_%d.png' % frames)
+        make_sheet(path, frames)
+        animation = run.Animation(path, rows=frames, cols=1, frameTime=100)
+        animation.play()
+        start_times = animation._startTimes
+        target = start_times[-1] // 2
+        results['animation'][frames] = {
+            'getCurrentFrame': timed(animation.getCurrentFrame, number),
+            'findStartTime': timed(lambda: run.findStartTime(start_times, target), number),
+            '_propGetElapsed': timed(animation._propGetElapsed, number)}
+
+
+def micro_collide(results, sizes, number, workdir, rnd):
+    for width, height in sizes:
+        path = make_level_files(workdir, 'collide_%dx%d.png' % (width, height), width, height, 0, rnd)
+        player = run.Player((run.TILE_SIZE * 2, (height - 3) * run.TILE_SIZE))
+        level = run.Level(path, player)
+        # one sprite per solid tile, the way levels used to be built
+        tiles = pygame.sprite.Group()
+        for j in range(level.grid.height):
+            for i in range(level.grid.width):
+                value = level.grid.get(i, j)
+                if value:
+                    run.Platform((i * run.TILE_SIZE, j * run.TILE_SIZE), tiles,
+                                 type='upper' if value == run.UPPER else 'full')
+        # one sprite per merged rectangle
+        merged = pygame.sprite.Group()
+        for x, y, w, h, value in level.grid.merge():
+            run.Platform((x * run.TILE_SIZE, y * run.TILE_SIZE), merged).rect = level.grid.tile_rect(x, y, value, w, h)
+        start = player.rect.copy()
+
+        def collide(group):
+            player.rect = start.copy()
+            player.rect.x += 5
+            player.collide(5, 0, group)
+            player.rect.y += 8
+            player.collide(0, 8, group)
+        results['collide']['%dx%d' % (width, height)] = {
+            'tiles': len(tiles),
+            'merged_platforms': len(merged),
+            'grid': timed(lambda: collide(level.grid), number),
+            'merged': timed(lambda: collide(merged), number),
+            'per_tile': timed(lambda: collide(tiles), max(1, number // 10))}
+
+
+def micro_spritecollide(results, sprite_counts, number, rnd):
+    area = run.TILE_SIZE * 200
+    for count in sprite_counts:
+        group = pygame.sprite.Group()
+        for _ in range(count):
+            sprite = pygame.sprite.Sprite(group)
+            sprite.rect = pygame.Rect(rnd.randrange(area), rnd.randrange(area), 32, 32)
+            sprite.imagerect = sprite.rect.inflate(16, 16)
+        probe = pygame.sprite.Sprite()
+        probe.rect = pygame.Rect(area // 2, area // 2, 32, 32)
+        probe.imagerect = probe.rect.inflate(64, 32)
+        results['spritecollide'][count] = {
+            'spritecollide': timed(lambda: run.spritecollide(probe, group), number),
+            'imagecollide': timed(lambda: run.imagecollide(probe, group), number)}
+
+
+def micro_build_layer(results, sizes, workdir, rnd):
+    for width, height in sizes:
+        path = os.path.join(workdir, 'layer_%dx%d.png' % (width, height))
+        make_layer(path, width, height, rnd)
+        results['build_layer']['%dx%d' % (width, height)] = timed(lambda: run.build_layer(path), 1)
+
+
+def micro_level(results, sizes, workdir, rnd):
+    # being a first load this includes parsing the level and its layer
+    # images and compiling them, the layer chunks are built on first draw
+    player = run.Player((run.TILE_SIZE, run.TILE_SIZE))
+    for width, height in sizes:
+        path = make_level_files(workdir, 'level_%dx%d.png' % (width, height), width, height, width * height // 20, rnd)
+        results['level_init']['%dx%d' % (width, height)] = timed(lambda: run.Level(path, player), 1)
+
+
+def micro_parse_level(results, sizes, workdir, rnd):
+    # reading the level image itself, vectorized and pixel by pixel
+    numpy = run.numpy
+    for width, height in sizes:
+        path = make_level_files(workdir, 'parse_%dx%d.png' % (width, height), width, height, width * height // 20, rnd)
+        result = {}
+        if numpy is not None:
+            result['numpy'] = timed(lambda: run.parse_level(path), 1)
+        run.numpy = None
+        try:
+            result['pixels'] = timed(lambda: run.parse_level(path), 1)
+        finally:
+            run.numpy = numpy
+        results['parse_level']['%dx%d' % (width, height)] = result
+
+
+def micro_camera_draw(results, sprite_counts, number, workdir, rnd):
+    surface = pygame.Surface(run.SCREEN_SIZE.size)
+    for count in sprite_counts:
+        width = max(40, int(math.sqrt(count * 20)))
+        height = max(20, width // 4)
+        path = make_level_files(workdir, 'camera_%d.png' % count, width, height, count, rnd)
+        player = run.Player((run.TILE_SIZE * 2, (height - 3) * run.TILE_SIZE))
+        level = run.Level(path, player)
+        camera = run.CameraAwareLayeredUpdates(player, pygame.Rect(0, 0, level.width, level.height), run.SCREEN_SIZE)
+        camera.set_scene(level)
+        camera.readjust()
+        results['camera_draw'][count] = {
+            'entities': len(level.entities),
+            'seconds': timed(lambda: camera.draw(surface), number)}
+
+
+def micro_command(args):
+    if Image is None:
+        print('the micro benchmarks need PIL to write their synthetic levels', file=sys.stderr)
+        return 1
+    init_headless()
+    provide_resources()
+    rnd = random.Random(args.seed)
+    results = {'benchmark': 'micro', 'seed': args.seed, 'number': args.number,
+               'animation': {}, 'collide': {}, 'spritecollide': {},
+               'build_layer': {}, 'parse_level': {}, 'level_init': {}, 'camera_draw': {}}
+    workdir = tempfile.mkdtemp(prefix='pixel_knight_bench_')
+    try:
+        micro_animation(results, args.frames, args.number, workdir)
+        micro_collide(results, args.level_sizes, args.number, workdir, rnd)
+        micro_spritecollide(results, args.sprites, args.number, rnd)
+        micro_build_layer(results, args.level_sizes, workdir, rnd)
+        micro_parse_level(results, args.level_sizes, workdir, rnd)
+        micro_level(results, args.level_sizes, workdir, rnd)
+        micro_camera_draw(results, args.sprites, max(1, args.number // 100), workdir, rnd)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name in ('animation', 'collide', 'spritecollide', 'build_layer', 'parse_level', 'level_init', 'camera_draw'):
+        for size, value in results[name].items():
+            if isinstance(value, dict):
+                timings = ['%s %.2f us' % (key, seconds * 1e6) for key, seconds in value.items()
+                           if isinstance(seconds, float)]
+                counts = ['%s %d' % (key, n) for key, n in value.items() if isinstance(n, int)]
+                print('%-14s %-10s %s' % (name, size, '  '.join(counts + timings)), file=sys.stderr)
+            else:
+                print('%-14s %-10s %.2f ms' % (name, size, value * 1e3), file=sys.stderr)
+    if args.json:
+        write_json(results, args.json)
+    return 0
+
+
+def clear_caches():
+    run.assets.clear()
+    run.soundbank.clear()
+    run.textcache.clear()
+
+
+def timed_phases(func):
+    """Run func once, returning its wall time and the profiler sections it hit."""
+    run.profiler.reset()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    phases = {name: value['seconds'] for name, value in run.profiler.report().items()}
+    return {'seconds': seconds, 'phases': phases}
+
+
+def print_phases(name, result):
+    phases = '  '.join('%s %.1f' % (phase, seconds * 1e3)
+                       for phase, seconds in sorted(result['phases'].items()))
+    print('%-22s %8.1f ms   %s' % (name, result['seconds'] * 1e3, phases), file=sys.stderr)
+
+
+def decode_sounds():
+    # the game decodes a sound the first time it plays, do it up front so
+    # a first run's decoding shows up in the startup numbers
+    with run.profiler.section('sounds'):
+        run.soundbank.preload()
+
+
+def startup_command(args):
+    """
+    Time each step of create_game(), then every level on its own. Cold
+    runs start from empty asset and sound caches, warm runs reuse what
+    the cold run loaded. The sounds requested by each step are decoded as
+    part of it. The OS file cache is warm either way, run the benchmark
+    in a fresh process for numbers after a reboot.
+    """
+    results = {'benchmark': 'startup', 'startup': {}, 'levels': {}}
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    run.profiler.enabled = True
+    startup = results['startup']
+    startup['pygame.init'] = timed_phases(pygame.init)
+    startup['set_mode'] = timed_phases(lambda: pygame.display.set_mode(run.SCREEN_SIZE.size))
+
+    def build_options():
+        run.options = run.OptionsHandler()
+
+    def build(cache):
+        if cache == 'cold':
+            clear_caches()
+        startup['OptionsHandler ' + cache] = timed_phases(build_options)
+        startup['Menu ' + cache] = timed_phases(run.Menu)
+        startup['GamePlay ' + cache] = timed_phases(run.GamePlay)
+        startup['sounds ' + cache] = timed_phases(decode_sounds)
+    build('cold')
+    build('warm')
+    for name, result in startup.items():
+        print_phases(name, result)
+
+    player = run.Player((run.TILE_SIZE, run.TILE_SIZE))
+    for name in ["level_100.png"] + LEVELS:
+        def build_level():
+            level = run.Level(name, player)
+            # the chunks are otherwise rendered on first draw, each one
+            # recorded as level.layers
+            for layer in (level.background, level.foreground):
+                if layer.chunks is not None:
+                    layer.chunks.build()
+            decode_sounds()
+        clear_caches()
+        cold = timed_phases(build_level)
+        warm = timed_phases(build_level)
+        results['levels'][name] = {'cold': cold, 'warm': warm}
+        print_phases(name + ' cold', cold)
+        print_phases(name + ' warm', warm)
+    run.profiler.enabled = False
+    results['assets'] = run.assets.stats()
+    results['sounds'] = run.soundbank.stats()
+    results['peak_rss_kb'] = peak_rss_kb()
+    if args.json:
+        write_json(results, args.json)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pixel Knight performance benchmarks")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    frames = commands.add_parser('frames', help="end-to-end frame times for each level")
+    frames.add_argument('--ticks', type=int, default=1200, help="simulation steps per level")
+    frames.add_argument('--levels', nargs='+', default=LEVELS, choices=LEVELS)
+    frames.add_argument('--replay', metavar='FILE', help="drive the levels with a recorded input file instead of the script")
+    frames.add_argument('--seed', type=int, default=0)
+    frames.add_argument('--json', metavar='FILE', help="write the results as JSON to FILE ('-' for stdout)")
+    frames.add_argument('--baseline', metavar='FILE', help="compare against a previous JSON result and flag regressions")
+    frames.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown before flagging a regression")
+    frames.set_defaults(func=frames_command)
+
+    micro = commands.add_parser('micro', help="isolated hot path benchmarks at configurable sizes")
+    micro.add_argument('--frames', type=int, nargs='+', default=[4, 16, 64],
+                       help="animation frame counts")
+    micro.add_argument('--sprites', type=int, nargs='+', default=[100, 1000, 5000],
+                       help="sprite counts for the collision helpers and camera draw")
+    micro.add_argument('--level-sizes', type=level_size, nargs='+', default=[(40, 20), (120, 30), (200, 100)],
+                       metavar='WxH', help="level sizes in tiles for collision, build_layer and Level")
+    micro.add_argument('--number', type=int, default=10000, help="calls per timing of the fast paths")
+    micro.add_argument('--seed', type=int, default=0)
+    micro.add_argument('--json', metavar='FILE', help="write the results as JSON to FILE ('-' for stdout)")
+    micro.set_defaults(func=micro_command)
+
+    startup = commands.add_parser('startup', help="launch and level load times broken down by phase")
+    startup.add_argument('--json', metavar='FILE', help="write the results as JSON to FILE ('-' for stdout)")
+    startup.set_defaults(func=startup_command)
+
+    args = parser.parse_args(argv)
+    status = args.func(args)
+    pygame.quit()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
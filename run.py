@@ -1,12 +1,23 @@
 import os
 import sys
+import argparse
+import struct
+import zlib
+import hashlib
+import tempfile
 import pygame
 import pyganim
 import random
 import time
 import math
+import io
+import collections
 from pygame.locals import *
 from PIL import Image
+try:
+    import numpy
+except ImportError:  # levels are parsed pixel by pixel without it
+    numpy = None
 
 # GLOBAL CONSTANTS
 # Game Constants
@@ -15,7 +26,12 @@ SCREEN_HEIGHT = 480
 SCREEN_SIZE = pygame.Rect((0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
 SCREEN_RATIO = SCREEN_WIDTH / SCREEN_HEIGHT
 TILE_SIZE = 32
+TICK_RATE = 60  # simulation steps per second
+TIMESTEP = 1000 / TICK_RATE  # milliseconds per simulation step
+MAX_FRAME_TIME = 250  # longest frame the simulation will try to catch up on
 GRAVITY = pygame.Vector2((0, 1.0))
+LAYER_CACHE_DIR = None  # directory to cache rendered level layers in, None renders them every load
+LAYER_CHUNK_SIZE = 512  # level layers are rendered and drawn in square chunks of this many pixels
 VOLUME = 0.025
 TILE_DICT = {   (0, 0, 0, 255): "foreground_0.png",
                 (5, 5, 5, 255): "foreground_1.png",
@@ -51,7 +67,42 @@ TILE_DICT = {   (0, 0, 0, 255): "foreground_0.png",
 PLAYING = 'playing'
 PAUSED = 'paused'
 STOPPED = 'stopped'
-TIME_FUNC = lambda: int(time.time() * 1000)
+TIME_FUNC = lambda: sim_clock.now()  # animations run on simulation time
+# Level Constants
+TILE_NAMES = [None] + list(TILE_DICT.values())  # tile layer index -> tile image, 0 is empty
+TILE_INDEX = {color: TILE_NAMES.index(name) for color, name in TILE_DICT.items()}
+TILE_TABLE_CRC = zlib.crc32(','.join(TILE_NAMES[1:]).encode())
+SPAWN_KINDS = ('door', 'gate', 'snake', 'rat', 'coin', 'key', 'diamond', 'heart')
+SPAWN_COLORS = {(128, 0, 255): 'gate',
+                (255, 128, 0): 'snake',
+                (128, 64, 0): 'rat',
+                (255, 216, 0): 'coin',
+                (0, 0, 255): 'key',
+                (0, 255, 255): 'diamond',
+                (255, 0, 0): 'heart'}
+SPAWN_CODES = {color: SPAWN_KINDS.index(kind) for color, kind in SPAWN_COLORS.items()}
+LEVEL_NAMES = ["level_100.png",  # level 100 is a throwaway level that makes the level numbers for the door system match up
+               "level_101.png", "level_102.png", "level_103.png",
+               "level_104.png", "level_105.png", "level_106.png"]
+DOOR_PRELOAD_RADIUS = TILE_SIZE * 8  # how close to a door the player gets before its destination is preloaded
+PRELOAD_TIME = 0.002  # seconds of layer chunk rendering a simulation step spends on preloaded levels
+LEVEL_CACHE_BUDGET = 128 * 1024 * 1024  # bytes of level layers kept loaded before levels get evicted
+TEXT_CACHE_SIZE = 256  # rendered strings kept before the least recently used go
+DIGITS = "0123456789"
+SPAWN_PRESENT = 0  # states of a level's spawns kept for evicted levels
+SPAWN_GONE = 1  # collected or killed
+SPAWN_OPEN = 2  # an unlocked gate
+LEVEL_MAGIC = b'PKLV'
+LEVEL_VERSION = 1
+LEVEL_HEADER_SIZE = 10 + 20 * 3 + 4  # magic, version, colour table crc, 3 source stamps, size
+# Collision Constants
+EMPTY = 0
+SOLID = 1
+UPPER = 2  # only the upper half of the tile is solid
+GRID_COLORS = {(0, 0, 0): SOLID, (20, 20, 20): UPPER}  # level image colours of collision tiles
+# compiled levels made with other colour tables are stale
+LEVEL_TABLE_CRC = zlib.crc32(repr((sorted(TILE_INDEX.items()), sorted(GRID_COLORS.items()),
+                                   sorted(SPAWN_COLORS.items()), SPAWN_KINDS)).encode())
 
 
 class Game(object):
@@ -61,26 +112,43 @@ class Game(object):
     and keeping it updated.
     """
 
-    def __init__(self, screen, states, start_state):
+    def __init__(self, screen, states, start_state, headless=False):
         """
         Initialize the Game object.
+
+        headless: skip display scaling and flipping and don't cap the
+        frame rate, for running the simulation without a window
         """
         self.done = False
+        self.headless = headless
         self.screen = screen
         self._screen = self.screen.copy()
         self._screen_width = 0
         self._screen_height = 0
         self.clock = pygame.time.Clock()
-        self.fps = 120
+        self.fps = 0 if headless else 120  # render rate cap, the simulation always runs at TICK_RATE
+        self.alpha = 1.0  # how far between the last two simulation steps the frame is drawn
         self.states = states
         self.state_name = start_state
         self.state = self.states[self.state_name]
         self.cutscene = Cutscene()
+        # where each step's input comes from, see LiveInput, InputRecorder and InputReplay
+        self.input = LiveInput()
+        self.inputs = InputFrame()  # the input for the step being simulated
+        self.events = []  # events waiting for the next step
 
     def event_loop(self):
-        """Events are passed for handling to the current state."""
+        """
+        Events are queued and passed for handling to the current
+        state on the next simulation step.
+        """
         for event in pygame.event.get():
-            self.state.get_event(event)
+            # the overlay is not part of the simulation, so F3
+            # is handled here and never reaches the states
+            if event.type == KEYDOWN and event.key == K_F3:
+                overlay.toggle()
+                continue
+            self.events.append(event)
 
             if event.type == VIDEORESIZE:
                 self._screen_width = event.w
@@ -106,6 +174,15 @@ class Game(object):
 
         dt: milliseconds since last frame
         """
+        if self.input.finished:
+            self.done = True
+            return
+        self.inputs = self.input.poll(self.events)
+        self.events = []
+        for event in self.inputs.get_events():
+            self.state.get_event(event)
+        sim_clock.advance(dt)
+
         if self.state.quit:
             self.done = True
         elif self.state.done:
@@ -115,20 +192,72 @@ class Game(object):
 
     def draw(self):
         """Pass display surface to active state for drawing."""
-        self.state.draw(self._screen)
+        with profiler.section('draw'):
+            self.state.draw(self._screen)
+        if overlay.enabled:
+            overlay.draw(self._screen, self)
 
     def run(self):
         """
         Pretty much the entirety of the game's runtime will be
         spent inside this while loop.
+
+        The simulation advances in fixed TIMESTEP steps, as many as the
+        elapsed time calls for, and each frame is drawn interpolated
+        between the last two steps.
         """
+        accumulator = 0.0
         while not self.done:
-            dt = self.clock.tick(self.fps)
-            self.event_loop()
-            self.update(dt)
+            # clamp long frames so a slow frame can't snowball into
+            # ever more catch-up steps
+            frame_time = self.clock.tick(self.fps)
+            accumulator += min(frame_time, MAX_FRAME_TIME)
+            if overlay.enabled:
+                overlay.end_frame(frame_time)
+                overlay.begin_frame()
+            with profiler.section('event'):
+                self.event_loop()
+            with profiler.section('update'):
+                while accumulator >= TIMESTEP and not self.done:
+                    self.update(TIMESTEP)
+                    accumulator -= TIMESTEP
+            self.alpha = accumulator / TIMESTEP
             self.draw()
-            self.screen.blit(pygame.transform.scale(self._screen, (self._screen_width, self._screen_height)), (0, 0))
-            pygame.display.update()
+            with profiler.section('scale'):
+                self.present()
+
+    def present(self):
+        """Scale the internal screen up to the window and flip it."""
+        if self.headless:
+            return
+        self.screen.blit(pygame.transform.scale(self._screen, (self._screen_width, self._screen_height)), (0, 0))
+        pygame.display.update()
+
+    def step(self, ticks=1, render=False):
+        """
+        Advance the simulation by a number of fixed steps as fast as
+        possible, independent of the clock.
+
+        render: also draw the internal screen after every step
+        """
+        for _ in range(ticks):
+            if self.done:
+                break
+            self.event_loop()
+            self.update(TIMESTEP)
+            if render:
+                self.alpha = 1.0
+                self.draw()
+
+    def simulate(self, ticks, render=False):
+        """
+        Step the simulation for a number of ticks and return how many
+        ticks per second were achieved.
+        """
+        start = time.perf_counter()
+        self.step(ticks, render)
+        elapsed = time.perf_counter() - start
+        return ticks / elapsed if elapsed > 0 else float('inf')
 
 
 class GameState(object):
@@ -146,7 +275,7 @@ class GameState(object):
         self.next_state = None
         self.screen_rect = pygame.display.get_surface().get_rect()
         self.persist = {}
-        self.font = pygame.font.Font(os.path.join("resources/font", "boxy_bold.ttf"), 32)
+        self.font = assets.font(os.path.join("resources/font", "boxy_bold.ttf"), 32)
 
     def startup(self, persistent):
         """
@@ -182,7 +311,7 @@ class GameState(object):
 class Menu(GameState):
     def __init__(self):
         super(Menu, self).__init__()
-        self.title = pygame.image.load(os.path.join("resources/images/gui", "title.png"))
+        self.title = assets.image(os.path.join("resources/images/gui", "title.png"), flags=None)
         #self.title = self.font.render("Press Any Key to Continue", True, pygame.Color("white"))
         #self.title_rect = self.title.get_rect(center=self.screen_rect.center)
         self.persist["screen_color"] = "black"
@@ -191,7 +320,7 @@ class Menu(GameState):
         '''
         Music
         '''
-        self.music = pygame.mixer.Sound('resources/sounds/music/menu.ogg')
+        self.music = soundbank.sound('resources/sounds/music/menu.ogg')
         self.music.set_volume(0.15)
         self.music.play(loops=-1)
 
@@ -204,7 +333,7 @@ class Menu(GameState):
 
     def update(self, dt):
         if game.cutscene.in_progress:
-            game.cutscene.update()
+            game.cutscene.update(dt)
             if game.cutscene.name is 'switch_play':
                 if game.cutscene.elapsed_time > 500:
                     self.done = True
@@ -228,59 +357,42 @@ class GamePlay(GameState):
     def __init__(self):
         super(GamePlay, self).__init__()
 
-        self.entities  = pygame.sprite.Group()
-        self.platforms = pygame.sprite.Group()
-        self.enemies   = pygame.sprite.Group()
-        self.items     = pygame.sprite.Group()
-        self.doors     = pygame.sprite.Group()
-        self.objects   = pygame.sprite.Group()
-        self.player = Player(self.platforms, self.enemies, self.items, self.doors, self.objects, (TILE_SIZE, 23 * TILE_SIZE), self.entities)
+        # every Level owns its own sprite groups, the player is pointed
+        # at the current level's groups by change_level()
+        self.player = Player((TILE_SIZE, 23 * TILE_SIZE))
         self.camera = CameraAwareLayeredUpdates(self.player, pygame.Rect(0, 0, 1, 1), SCREEN_SIZE)
         self.camera.readjust()
 
 
-        self.level_list = []
-        l00 = Level("level_100.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l01 = Level("level_101.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l02 = Level("level_102.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l03 = Level("level_103.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l04 = Level("level_104.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l05 = Level("level_105.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        l06 = Level("level_106.png", self.player, self.platforms, self.enemies, self.items, self.doors, self.objects, self.entities, self.camera)
-        self.level_list.append(l00) # level 00 is a throwaway level that makes the list indices for the door system match up
-        self.level_list.append(l01)
-        self.level_list.append(l02)
-        self.level_list.append(l03)
-        self.level_list.append(l04)
-        self.level_list.append(l05)
-        self.level_list.append(l06)
+        # levels are built the first time they're entered
+        self.levels = LevelCache(LEVEL_NAMES, self.player)
 
         self.current_level_number = 1
-        self.current_level = self.level_list[self.current_level_number]
+        self.current_level = self.levels.get(self.current_level_number)
         self.camera.level_size = pygame.Rect(0, 0, self.current_level.width, self.current_level.height)
         self.change_level(self.current_level_number, self.player.rect.center)
 
         self.next_state = "MENU"
 
-        self.darken_screen = pygame.image.load(os.path.join("resources/images/gui", "darken.png")).convert()
-        self.pause_screen = pygame.image.load(os.path.join("resources/images/gui", "pause.png")).convert()
-        self.gameover_screen = pygame.image.load(os.path.join("resources/images/gui", "game_over.png")).convert_alpha()
-        self.win_screen = pygame.image.load(os.path.join("resources/images/gui", "win.png")).convert_alpha()
+        self.darken_screen = assets.image(os.path.join("resources/images/gui", "darken.png"))
+        self.pause_screen = assets.image(os.path.join("resources/images/gui", "pause.png"))
+        self.gameover_screen = assets.image(os.path.join("resources/images/gui", "game_over.png"), flags='convert_alpha')
+        self.win_screen = assets.image(os.path.join("resources/images/gui", "win.png"), flags='convert_alpha')
 
         '''
         Sounds
         '''
         self.sounds = {}
-        self.sounds['pause'] = [pygame.mixer.Sound('resources/sounds/ui/pause_in.wav')]
-        self.sounds['unpause'] = [pygame.mixer.Sound('resources/sounds/ui/pause_out.wav')]
+        self.sounds['pause'] = [soundbank.sound('resources/sounds/ui/pause_in.wav')]
+        self.sounds['unpause'] = [soundbank.sound('resources/sounds/ui/pause_out.wav')]
 
         '''
         Music
         '''
         self.music = {}
-        self.music['main'] = pygame.mixer.Sound('resources/sounds/music/main.ogg')
-        self.music['gameover'] = pygame.mixer.Sound('resources/sounds/music/gameover.ogg')
-        self.music['win'] = pygame.mixer.Sound('resources/sounds/music/win.ogg')
+        self.music['main'] = soundbank.sound('resources/sounds/music/main.ogg')
+        self.music['gameover'] = soundbank.sound('resources/sounds/music/gameover.ogg')
+        self.music['win'] = soundbank.sound('resources/sounds/music/win.ogg')
         self.music['main'].set_volume(0.05)
         self.music['gameover'].set_volume(0.15)
         self.music['win'].set_volume(0.15)
@@ -310,15 +422,21 @@ class GamePlay(GameState):
                             pygame.mixer.unpause()
 
     def update(self, dt):
-        if not self.paused:
-            if not self.gameover:
-                if not self.win:
-                    self.camera.update(self.current_level.entities)
-                    if game.cutscene.in_progress:
-                        game.cutscene.update()
+        if not self.paused and not self.gameover and not self.win:
+            self.camera.update()
+            if game.cutscene.in_progress:
+                game.cutscene.update(dt)
+            # get the level behind a nearby door ready before it's used
+            door = self.current_level.spatial.nearest(self.player.rect.center, Door, DOOR_PRELOAD_RADIUS)
+            if door:
+                self.levels.preload_door(door.travel_to_id)
+            self.levels.build_pending()
+        else:
+            # nothing moves, so there is nothing to interpolate between
+            self.camera.hold()
         if game.cutscene.in_progress:
             if game.cutscene.name is 'switch_menu':
-                game.cutscene.update()
+                game.cutscene.update(dt)
                 if game.cutscene.elapsed_time > 200:
                     pygame.mixer.stop()
                     self.paused = False
@@ -332,24 +450,34 @@ class GamePlay(GameState):
             for button in self.buttons:
                 button.get_event()
 
+    def checksum(self):
+        """
+        A CRC of the simulation state, two runs that end with the
+        same checksum played out identically.
+        """
+        state = [self.current_level_number, tuple(self.player.rect), tuple(self.player.vel),
+                 self.player.health, self.player.score, self.player.key]
+        for sprite in self.current_level.entities:
+            state.append((type(sprite).__name__, tuple(sprite.rect), getattr(sprite, 'health', None)))
+        return zlib.crc32(repr(state).encode('ascii'))
+
     def change_level(self, level_number, level_pos):
         self.current_level_number = level_number
-        self.current_level = self.level_list[self.current_level_number]
+        self.current_level = self.levels.get(self.current_level_number)
         self.player.rect.center = level_pos
-        self.player.platforms = self.current_level.platforms
+        self.player.grid = self.current_level.grid
+        self.player.spatial = self.current_level.spatial
         self.player.enemies = self.current_level.enemies
         self.player.items = self.current_level.items
         self.player.doors = self.current_level.doors
         self.player.objects = self.current_level.objects
         self.camera.level_size = pygame.Rect(0, 0, self.current_level.width, self.current_level.height)
+        self.camera.set_scene(self.current_level)
         self.camera.readjust()
-        for enemy in self.enemies:
-            enemy.platforms = self.current_level.platforms
-            enemy.objects = self.current_level.objects
 
     def draw(self, surface):
         surface.fill((0, 0, 0))
-        self.camera.draw(surface)
+        self.camera.draw(surface, game.alpha)
         if self.paused:
             surface.blit(self.darken_screen, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
             surface.blit(self.pause_screen, (0, 0))
@@ -383,8 +511,7 @@ class Cutscene(object):
         self.screen_overlay.fill((0, 0, 0))
         self.screen_overlay.set_alpha(self.alpha)
 
-    def update(self):
-        dt = game.clock.tick(game.fps)
+    def update(self, dt):
         self.elapsed_time += dt
         if self.duration > 0:
             if self.elapsed_time > self.duration:
@@ -453,32 +580,396 @@ class Cutscene(object):
         pass
 
 
+class SimulationClock(object):
+    """
+    Milliseconds of simulated time, advanced by every simulation step.
+    Animations are timed against it so a run doesn't depend on wall time.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self):
+        return int(self.time)
+
+    def advance(self, dt):
+        self.time += dt
+
+    def reset(self):
+        self.time = 0.0
+
+
+sim_clock = SimulationClock()
+
+
+class RandomStreams(object):
+    """
+    Independent seeded random number generators, one per system, so that
+    e.g. audio variation never shifts the sequence the enemy AI sees.
+    """
+
+    def __init__(self, seed=0):
+        self.streams = {}
+        self.seed(seed)
+
+    def seed(self, seed):
+        self._seed = seed
+        for name, stream in self.streams.items():
+            stream.seed('%s:%s' % (seed, name))
+
+    def stream(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = random.Random('%s:%s' % (self._seed, name))
+            self.streams[name] = stream
+        return stream
+
+
+rng = RandomStreams()
+
+
+class Profiler(object):
+    """
+    Accumulates wall time and call counts for named sections of code.
+
+    Sections may nest, each one records its own inclusive time. While
+    disabled section() hands back a shared no-op context, so instrumented
+    code costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.times = {}
+        self.counts = {}
+
+    def section(self, name):
+        if not self.enabled:
+            return NULL_SECTION
+        return ProfilerSection(self, name)
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        self.times = {}
+        self.counts = {}
+
+    def report(self):
+        return {name: {'seconds': seconds, 'calls': self.counts[name]}
+                for name, seconds in self.times.items()}
+
+
+class ProfilerSection(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullSection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SECTION = NullSection()
+profiler = Profiler()
+
+# Overlay Constants
+OVERLAY_SECTIONS = ('event', 'update', 'collision', 'draw', 'scale')
+
+
+class PerformanceOverlay(object):
+    """
+    Debug overlay toggled with F3. Shows the frame rate, a graph of recent
+    frame times, the time spent in each subsystem per frame (averaged over
+    the last `window` frames) and sprite, blit and Surface allocation
+    counts for the last frame.
+
+    Nothing is timed or counted while the overlay is hidden. Blits and
+    Surface allocations are counted where they're made: the sprite, layer
+    and HUD blits of the camera draw, and the Surfaces made by asset loads,
+    layer chunk builds and text renders.
+    """
+
+    def __init__(self, history=120, window=30):
+        self.enabled = False
+        self.history = history
+        self.window = window
+        self.frame_times = []
+        self.timings = {}
+        self.sampled = 0
+        self.blits = 0
+        self.allocations = 0
+        self.last_blits = 0
+        self.last_allocations = 0
+        self.counting = False
+        self.font = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        profiler.enabled = self.enabled
+        profiler.reset()
+        self.frame_times = []
+        self.sampled = 0
+
+    def count_allocation(self, count=1):
+        if self.counting:
+            self.allocations += count
+
+    def count_blits(self, count=1):
+        if self.counting:
+            self.blits += count
+
+    def begin_frame(self):
+        self.blits = 0
+        self.allocations = 0
+        self.counting = True
+
+    def end_frame(self, frame_time):
+        """Keep the counters and profiler sections of the finished frame."""
+        self.counting = False
+        self.last_blits = self.blits
+        self.last_allocations = self.allocations
+        self.sampled += 1
+        if self.sampled >= self.window:
+            self.timings = {name: seconds / self.sampled for name, seconds in profiler.times.items()}
+            profiler.reset()
+            self.sampled = 0
+        self.frame_times.append(frame_time)
+        if len(self.frame_times) > self.history:
+            del self.frame_times[0]
+
+    def draw(self, surface, game):
+        counting = self.counting
+        self.counting = False
+        if self.font is None:
+            self.font = assets.font(os.path.join("resources/font", "boxy_bold.ttf"), 10)
+        lines = []
+        if self.frame_times:
+            average = sum(self.frame_times) / len(self.frame_times)
+            lines.append("FPS %.0f  frame %.2f ms  max %.2f ms" % (
+                1000 / average if average else 0, self.frame_times[-1], max(self.frame_times)))
+        lines.append("  ".join("%s %.2f" % (name, self.timings.get(name, 0.0) * 1000)
+                               for name in OVERLAY_SECTIONS))
+        camera = getattr(game.state, 'camera', None)
+        if camera is not None and camera.level is not None:
+            total = sum(len(level.entities) for level in game.state.levels.loaded()) + 1
+            lines.append("sprites %d  active %d  drawn %d  culled %d" % (
+                total, len(camera.scene) + 1, camera.drawn, camera.culled))
+        lines.append("blits %d  surface allocations %d" % (self.last_blits, self.last_allocations))
+
+        panel = pygame.Rect(4, SCREEN_HEIGHT - 16 * len(lines) - 72, 360, 16 * len(lines) + 68)
+        surface.fill((0, 0, 0), panel)
+        for n, line in enumerate(lines):
+            surface.blit(self.font.render(line, False, pygame.Color("white")), (panel.x + 4, panel.y + 4 + 16 * n))
+
+        # frame time graph, the line marks one simulation step
+        graph = pygame.Rect(panel.x + 4, panel.bottom - 60, panel.width - 8, 56)
+        pygame.draw.rect(surface, (40, 40, 40), graph)
+        scale = graph.height / (TIMESTEP * 2)
+        for n, frame_time in enumerate(self.frame_times[-graph.width // 2:]):
+            height = min(graph.height, int(frame_time * scale))
+            color = (80, 220, 80) if frame_time <= TIMESTEP else (230, 60, 60)
+            pygame.draw.line(surface, color, (graph.x + n * 2, graph.bottom - 1),
+                             (graph.x + n * 2, graph.bottom - height))
+        target = graph.bottom - int(TIMESTEP * scale)
+        pygame.draw.line(surface, (200, 200, 200), (graph.x, target), (graph.right - 1, target))
+        self.counting = counting
+
+
+overlay = PerformanceOverlay()
+
+# Input Constants
+INPUT_KEYS = (K_w, K_a, K_d, K_e, K_SPACE, K_ESCAPE)  # the keys gameplay reads
+INPUT_BITS = {key: 1 << bit for bit, key in enumerate(INPUT_KEYS)}
+INPUT_EVENTS = {QUIT: 0, KEYDOWN: 1}  # event types passed to states, with their replay codes
+REPLAY_MAGIC = b'PKRP'
+REPLAY_VERSION = 1
+
+
+class InputFrame(object):
+    """
+    The keyboard, mouse and event input for a single simulation step.
+    It can be indexed by key like the result of pygame.key.get_pressed().
+    """
+
+    def __init__(self, keys=0, mouse_pos=(0, 0), mouse_buttons=0, events=()):
+        self.keys = keys  # bitmask over INPUT_KEYS
+        self.mouse_pos = mouse_pos
+        self.mouse_buttons = mouse_buttons  # bitmask over the three mouse buttons
+        self.mouse_pressed = tuple(1 if mouse_buttons & (1 << i) else 0 for i in range(3))
+        self.events = tuple(events)  # (event type, key) pairs
+
+    def __getitem__(self, key):
+        return bool(self.keys & INPUT_BITS.get(key, 0))
+
+    def get_events(self):
+        return [pygame.event.Event(type, key=key) for type, key in self.events]
+
+
+class LiveInput(object):
+    """Reads the keyboard and mouse at each simulation step."""
+    finished = False
+
+    def poll(self, events):
+        pressed = pygame.key.get_pressed()
+        keys = 0
+        for key, bit in INPUT_BITS.items():
+            if pressed[key]:
+                keys |= bit
+        buttons = 0
+        for i, button in enumerate(pygame.mouse.get_pressed()[:3]):
+            if button:
+                buttons |= 1 << i
+        frame_events = [(event.type, getattr(event, 'key', 0)) for event in events if event.type in INPUT_EVENTS]
+        return InputFrame(keys, pygame.mouse.get_pos(), buttons, frame_events)
+
+
+class InputRecorder(object):
+    """Passes input through from another source and records every step of it."""
+
+    def __init__(self, source, seed, start_state):
+        self.source = source
+        self.seed = seed
+        self.start_state = start_state
+        self.frames = []
+
+    @property
+    def finished(self):
+        return self.source.finished
+
+    def poll(self, events):
+        frame = self.source.poll(events)
+        self.frames.append(frame)
+        return frame
+
+    def save(self, path):
+        write_replay(path, self.seed, self.start_state, self.frames)
+
+
+class InputReplay(object):
+    """Feeds back the input steps of a recording, then reports finished."""
+
+    def __init__(self, path):
+        self.seed, self.start_state, self.frames = read_replay(path)
+        self.index = 0
+
+    @property
+    def finished(self):
+        return self.index >= len(self.frames)
+
+    def poll(self, events):
+        if self.finished:
+            return InputFrame()
+        frame = self.frames[self.index]
+        self.index += 1
+        return frame
+
+
+def write_replay(path, seed, start_state, frames):
+    # header: magic, version, seed, start state, step count
+    # body (zlib): per step the key bitmask, mouse position, mouse button
+    # bitmask and event count, followed by (event code, key) per event
+    body = []
+    for frame in frames:
+        body.append(struct.pack('<BhhBB', frame.keys, frame.mouse_pos[0], frame.mouse_pos[1],
+                                frame.mouse_buttons, len(frame.events)))
+        for type, key in frame.events:
+            body.append(struct.pack('<BI', INPUT_EVENTS[type], key))
+    state = start_state.encode('ascii')
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sHIB', REPLAY_MAGIC, REPLAY_VERSION, seed, len(state)))
+        f.write(state)
+        f.write(struct.pack('<I', len(frames)))
+        f.write(zlib.compress(b''.join(body)))
+
+
+def read_replay(path):
+    types = {code: type for type, code in INPUT_EVENTS.items()}
+    with open(path, 'rb') as f:
+        magic, version, seed, length = struct.unpack('<4sHIB', f.read(11))
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError('%s is not a version %d replay file' % (path, REPLAY_VERSION))
+        start_state = f.read(length).decode('ascii')
+        count, = struct.unpack('<I', f.read(4))
+        body = zlib.decompress(f.read())
+    frames = []
+    offset = 0
+    for _ in range(count):
+        keys, x, y, buttons, n = struct.unpack_from('<BhhBB', body, offset)
+        offset += 7
+        events = []
+        for _ in range(n):
+            code, key = struct.unpack_from('<BI', body, offset)
+            offset += 5
+            events.append((types[code], key))
+        frames.append(InputFrame(keys, (x, y), buttons, events))
+    return seed, start_state, frames
+
+
 class CameraAwareLayeredUpdates(pygame.sprite.LayeredUpdates):
-    def __init__(self, target, level_size, screen_size):
+    def __init__(self, target, level_size, screen_size, cull_margin=TILE_SIZE * 3):
         super().__init__()
         self.target = target
         self.camera = pygame.Vector2(0, 0)
+        self.prev_camera = None  # camera position before the last simulation step
+        self.view = pygame.Vector2(0, 0)  # interpolated camera position being drawn
         self.level_size = level_size
         self.screen_size = screen_size
+        # sprites whose rect is further than cull_margin off screen are not drawn,
+        # the margin covers image offsets such as the player's attack frames
+        self.cull_margin = cull_margin
+        self.alpha = 1.0
+        self.drawn = 0
+        self.culled = 0
         if self.target:
             self.add(target)
         self.lostSprites = []
-        self.active_sprites = []
-        vignette = pygame.image.load(os.path.join("resources/images/misc", "vignette.png")).convert_alpha()
-        self.vignette = pygame.transform.scale(vignette, (SCREEN_WIDTH, SCREEN_HEIGHT))
-        self.font = pygame.font.Font(os.path.join("resources/font", "boxy_bold.ttf"), 20)
+        # the level being shown, its entities group is the scene that gets
+        # updated and drawn, everything else is left alone
+        self.level = None
+        self.scene = pygame.sprite.Group()
+        # last blit rect of each scene sprite, for the dirty rect list
+        self.scene_rects = {}
+        self.vignette = assets.image(os.path.join("resources/images/misc", "vignette.png"),
+                                     size=(SCREEN_WIDTH, SCREEN_HEIGHT), flags='convert_alpha')
         self.ui_health = Animation(os.path.join("resources/images/gui", "health.png"), rows=14, cols=1, loop=False)
-        self.ui_score = self.font.render("- SCORE -", True, pygame.Color("white"))
-        self.ui_score_value = self.font.render("00000000", True, pygame.Color("white"))
-        self.ui_key = pygame.image.load(os.path.join("resources/images/gui", "key.png")).convert_alpha()
-        self.ui_key = pygame.transform.scale(self.ui_key, (64, 64))
-
-    def update(self, active_sprites):
-        self.active_sprites = []
-        self.active_sprites = active_sprites
-        for s in self.sprites():
-            if s in self.active_sprites:
-                s.update()
+        self.ui_score = textcache.render(os.path.join("resources/font", "boxy_bold.ttf"), 20, "- SCORE -")
+        # the score is only redrawn when it changes
+        self.score_shown = 0
+        self.ui_score_value = textcache.number(os.path.join("resources/font", "boxy_bold.ttf"), 20, 0, digits=8)
+        self.ui_key = assets.image(os.path.join("resources/images/gui", "key.png"), size=(64, 64), flags='convert_alpha')
+
+    def set_scene(self, level):
+        """Switch to the entities and layers of the level being entered."""
+        self.level = level
+        self.scene = level.entities
+        self.scene_rects = {}
+        # don't interpolate across the jump to the new level
+        self.prev_camera = None
+        if self.target:
+            self.target.prev_pos = None
+
+    def update(self):
+        # remember where everything was for render interpolation
+        self.prev_camera = pygame.Vector2(self.camera)
+        for s in self.scene.sprites():
+            s.prev_pos = s.rect.topleft
+        if self.target:
+            self.target.prev_pos = self.target.rect.topleft
+        for s in self.scene.sprites():
+            s.update()
         if self.target:
             if type(self.target).__name__ is 'Player':
                 self.target.update()
@@ -487,7 +978,18 @@ class CameraAwareLayeredUpdates(pygame.sprite.LayeredUpdates):
             self.camera += (pygame.Vector2((x, y)) - self.camera) * 0.05
             self.camera.x = max(-(self.level_size.width - self.screen_size.width), min(0, self.camera.x))
             self.camera.y = max(-(self.level_size.height - self.screen_size.height), min(0, self.camera.y))
-            self.ui_score_value = self.font.render(str(self.target.score).zfill(8), True, pygame.Color("white"))
+            if self.target.score != self.score_shown:
+                self.score_shown = self.target.score
+                self.ui_score_value = textcache.number(os.path.join("resources/font", "boxy_bold.ttf"), 20,
+                                                       self.score_shown, digits=8)
+
+    def hold(self):
+        """Draw everything where it is now, for steps the scene doesn't update."""
+        self.prev_camera = pygame.Vector2(self.camera)
+        for s in self.scene.sprites():
+            s.prev_pos = s.rect.topleft
+        if self.target:
+            self.target.prev_pos = self.target.rect.topleft
 
     def readjust(self):
         if self.target:
@@ -505,38 +1007,61 @@ class CameraAwareLayeredUpdates(pygame.sprite.LayeredUpdates):
             if dx != 0 or dy != 0:
                 self.readjust()
 
-    def draw(self, surface):
+    def draw(self, surface, alpha=1.0):
+        """
+        alpha: how far between the previous and the current simulation
+        step to draw everything, 1.0 draws the current positions
+        """
         self.lostSprites = []
+        self.alpha = alpha
+        if self.prev_camera is None:
+            self.view = pygame.Vector2(self.camera)
+        else:
+            self.view = self.prev_camera + (self.camera - self.prev_camera) * alpha
 
-        background = game.state.level_list[game.state.current_level_number].background
-        background = surface.blit(background.image, background.rect.move(self.camera))
-        self.lostSprites.append(background)
-        for sprite in self.sprites():
-            if sprite in self.active_sprites:
-                if type(sprite).__name__ is 'Door':
-                    self.spriteblit(sprite, surface)
-                if type(sprite).__class__.__bases__[0].__name__ is 'Item':
+        self.lostSprites.extend(self.level.background.draw(surface, self.view))
+        # cull everything off screen before sorting and blitting
+        view = self.viewport()
+        sprites = self.scene.sprites()
+        if self.target:
+            sprites.append(self.target)
+        visible = [s for s in sprites if view.colliderect(s.rect)]
+        self.drawn = len(visible)
+        self.culled = len(sprites) - self.drawn
+        for sprite in visible:
+            if type(sprite).__name__ is 'Door':
+                self.spriteblit(sprite, surface)
+            if type(sprite).__class__.__bases__[0].__name__ is 'Item':
+                self.spriteblit(sprite, surface)
+        for sprite in sorted(visible, key=self.sort_by_x):
+            if type(sprite).__name__ not in ['Door']:
+                if type(sprite).__class__.__bases__[0].__name__ not in ['Item']:
                     self.spriteblit(sprite, surface)
-        for sprite in sorted(self.sprites(), key=self.sort_by_x):
-            if sprite in self.active_sprites or type(sprite).__name__ is 'Player':
-                if type(sprite).__name__ not in ['Door']:
-                    if type(sprite).__class__.__bases__[0].__name__ not in ['Item']:
-                        self.spriteblit(sprite, surface)
-        foreground = game.state.level_list[game.state.current_level_number].foreground
-        foreground = surface.blit(foreground.image, foreground.rect.move(self.camera))
-        self.lostSprites.append(foreground)
+        self.lostSprites.extend(self.level.foreground.draw(surface, self.view))
         surface.blit(self.vignette, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
         surface.blit(self.ui_health.getFrame(self.target.health), (16, 16))
         surface.blit(self.ui_score, (600, 16))
         surface.blit(self.ui_score_value, (602, 48))
         if self.target.key:
             surface.blit(self.ui_key, (782, 4))
+        overlay.count_blits(5 if self.target.key else 4)
 
         return self.lostSprites
 
+    def viewport(self):
+        # the area of the level on screen, widened by the cull margin
+        view = pygame.Rect(int(-self.camera.x), int(-self.camera.y), self.screen_size.width, self.screen_size.height)
+        return view.inflate(self.cull_margin * 2, self.cull_margin * 2)
+
     def spriteblit(self, sprite, surface):
-        rect = self.spritedict[sprite]
-        newrect = surface.blit(sprite.image, sprite.rect.move(self.camera).move(sprite.offset))
+        if sprite in self.spritedict:
+            spritedict = self.spritedict
+        else:
+            spritedict = self.scene_rects
+        rect = spritedict.get(sprite, self._init_rect)
+        pos = self.interpolate(sprite) + self.view + sprite.offset
+        newrect = surface.blit(sprite.image, (int(pos.x), int(pos.y)))
+        overlay.count_blits()
         if rect is self._init_rect:
             self.lostSprites.append(newrect)
         else:
@@ -545,7 +1070,14 @@ class CameraAwareLayeredUpdates(pygame.sprite.LayeredUpdates):
             else:
                 self.lostSprites.append(newrect)
                 self.lostSprites.append(rect)
-        self.spritedict[sprite] = newrect
+        spritedict[sprite] = newrect
+
+    def interpolate(self, sprite):
+        # the sprite's position between its last two simulation steps
+        prev = sprite.prev_pos
+        if prev is None:
+            return pygame.Vector2(sprite.rect.topleft)
+        return pygame.Vector2(prev) + (pygame.Vector2(sprite.rect.topleft) - prev) * self.alpha
 
     def sort_by_x(self, sprite):
         return -sprite.rect.centerx
@@ -553,82 +1085,799 @@ class CameraAwareLayeredUpdates(pygame.sprite.LayeredUpdates):
 
 def build_layer(level):
     # construct an image layer for a level
-    image = Image.open(level)
+    return render_layer(read_layer(level))
+
+
+def read_layer(path):
+    """Read a layer image into a TileLayer of TILE_DICT indices."""
+    image = Image.open(path)
+    width, height = image.size
+    layer = TileLayer(width, height)
+    if numpy is not None and image.mode in ('RGB', 'RGBA'):
+        pixels = numpy.asarray(image)
+        tiles = color_lookup(pack_colors(pixels), pixels.shape[2], TILE_INDEX)
+        layer.tiles = bytearray(tiles.tobytes())
+        return layer
     pixel = image.load()
-    width = (TILE_SIZE * int(image.size[0]))
-    height = (TILE_SIZE * int(image.size[1]))
-    layer = pygame.Surface((width, height), pygame.SRCALPHA, 32)
-    for i in range(image.size[0]):
-        for j in range(image.size[1]):
-            if pixel[i, j] in TILE_DICT.keys():
-                tile = pygame.image.load(os.path.join("resources/images/tiles", TILE_DICT[pixel[i, j]]))
-                tile = pygame.transform.scale(tile, (TILE_SIZE, TILE_SIZE))
-                layer.blit(tile, (i * TILE_SIZE, j * TILE_SIZE))
-
+    for i in range(width):
+        for j in range(height):
+            index = TILE_INDEX.get(pixel[i, j])
+            if index:
+                layer.tiles[j * width + i] = index
     return layer
 
 
-class Level(object):
-    def __init__(self, level, player, platforms, enemies, items, doors, objects, entities, camera):
-        image = Image.open(os.path.join("resources/images/levels", level))
+def pack_colors(pixels):
+    """
+    (height, width) uint32 array of the pixels of an image array, with
+    the channels packed into one integer each, first channel highest.
+    """
+    packed = numpy.zeros(pixels.shape[:2], numpy.uint32)
+    for channel in range(pixels.shape[2]):
+        packed <<= 8
+        packed |= pixels[:, :, channel]
+    return packed
+
+
+def color_lookup(packed, channels, table):
+    """
+    (height, width) uint8 array of the table values of packed pixels, 0
+    for colours not in the table. Only colours with as many channels as
+    the image can match, just like comparing pixel tuples.
+    """
+    colors = sorted((int.from_bytes(bytes(color), 'big'), value)
+                    for color, value in table.items() if len(color) == channels)
+    if not colors:
+        return numpy.zeros(packed.shape, numpy.uint8)
+    keys = numpy.array([key for key, value in colors], numpy.uint32)
+    values = numpy.array([value for key, value in colors], numpy.uint8)
+    # binary search every pixel for its colour in the sorted keys
+    found = numpy.minimum(numpy.searchsorted(keys, packed), len(keys) - 1)
+    return numpy.where(keys[found] == packed, values[found], 0).astype(numpy.uint8)
+
+
+def render_layer(layer, cache_dir=None):
+    """
+    Draw the tiles of a TileLayer onto a new Surface.
+
+    cache_dir: optional directory to keep rendered layers in as images,
+    named by a hash of the layer's tiles. Changes to the tile images
+    themselves aren't noticed, empty the directory after editing them.
+    """
+    if cache_dir:
+        key = hashlib.blake2b(struct.pack('<HHHI', layer.width, layer.height, TILE_SIZE, TILE_TABLE_CRC)
+                              + bytes(layer.tiles), digest_size=16).hexdigest()
+        path = os.path.join(cache_dir, 'layer_%s.png' % key)
+        if os.path.isfile(path):
+            try:
+                return pygame.image.load(path).convert_alpha()
+            except (OSError, pygame.error):
+                pass  # unreadable, render it again and replace it
+    surface = pygame.Surface((layer.width * TILE_SIZE, layer.height * TILE_SIZE), pygame.SRCALPHA, 32)
+    atlas = tile_atlas()
+    width = layer.width
+    surface.blits([(atlas[index], ((n % width) * TILE_SIZE, (n // width) * TILE_SIZE))
+                   for n, index in enumerate(layer.tiles) if index], False)
+    if cache_dir:
+        save_layer(surface, path)
+    return surface
+
+
+def save_layer(surface, path):
+    """
+    Save a rendered layer to the cache, through a temporary file so an
+    interrupted save never leaves a truncated image behind. A cache that
+    can't be written to is skipped.
+    """
+    temp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix='.png', prefix='layer_', dir=os.path.dirname(path))
+        os.close(fd)
+        pygame.image.save(surface, temp)
+        os.replace(temp, path)
+    except (OSError, pygame.error):
+        if temp is not None:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
+def tile_atlas():
+    """
+    Every tile in TILE_DICT, scaled to TILE_SIZE, indexed like TILE_NAMES.
+    The tiles come from the asset cache so each file is only decoded once.
+    """
+    return [None] + [assets.image(os.path.join("resources/images/tiles", name),
+                                  size=(TILE_SIZE, TILE_SIZE), flags='convert_alpha')
+                     for name in TILE_NAMES[1:]]
+
+
+class TileLayer(object):
+    """
+    The tiles of a background or foreground layer, one byte per tile
+    holding an index into TILE_NAMES, 0 where there is no tile.
+    """
+
+    def __init__(self, width, height, tiles=None):
+        self.width = width
+        self.height = height
+        self.tiles = tiles if tiles is not None else bytearray(width * height)
+
+    def crop(self, x, y, width, height):
+        """The tiles in a rectangle, clipped to the layer, as a new TileLayer."""
+        width = max(0, min(width, self.width - x))
+        height = max(0, min(height, self.height - y))
+        tiles = bytearray()
+        for j in range(y, y + height):
+            tiles += self.tiles[j * self.width + x:j * self.width + x + width]
+        return TileLayer(width, height, tiles)
+
+
+class LevelData(object):
+    """
+    Everything a Level is built from: the collision grid, the background
+    and foreground tile layers and the list of entities to spawn.
+
+    Parsed from the level images by parse_level() and stored in a compiled
+    .lvl file by write_level(), see load_level().
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.grid = bytearray(width * height)
+        # (kind, (i, j), data) in tile coordinates and column-major order,
+        # data is the (red, blue) door id pair for doors and None otherwise
+        self.spawns = []
+        self.background = None
+        self.foreground = None
+
+
+def level_sources(level):
+    """
+    The level, background and foreground image paths for a level file
+    name. The layers sit in background and foreground directories next
+    to the level, which also holds for a level given by absolute path.
+    """
+    directory, name = os.path.split(os.path.join("resources/images/levels", level))
+    return [os.path.join(directory, name),
+            os.path.join(directory, "background", name),
+            os.path.join(directory, "foreground", name)]
+
+
+def parse_level(level):
+    """Build a LevelData from the level images."""
+    level_path, background_path, foreground_path = level_sources(level)
+    image = Image.open(level_path)
+    width, height = image.size
+    data = LevelData(width, height)
+    if numpy is not None and image.mode in ('RGB', 'RGBA'):
+        # look the collision tiles and spawn kinds up for all pixels at
+        # once, then only visit the pixels that spawn something
+        pixels = numpy.asarray(image)
+        packed = pack_colors(pixels)
+        channels = pixels.shape[2]
+        data.grid = bytearray(color_lookup(packed, channels, GRID_COLORS).tobytes())
+        kinds = color_lookup(packed, channels, SPAWN_CODES)
+        doors = pixels[:, :, 1] == 248
+        # transposed so the points come out in column-major order
+        for i, j in numpy.argwhere((doors | (kinds != 0)).T).tolist():
+            if doors[j, i]:
+                data.spawns.append(('door', (i, j), (int(pixels[j, i, 0]), int(pixels[j, i, 2]))))
+            if kinds[j, i]:
+                data.spawns.append((SPAWN_KINDS[kinds[j, i]], (i, j), None))
+    else:
         pixel = image.load()
-        self.width  = image.size[0] * TILE_SIZE
-        self.height = image.size[1] * TILE_SIZE
-        self.entities  = []
-        self.platforms = []
-        self.enemies   = []
-        self.items     = []
-        self.doors     = []
-        self.objects   = []
-        self.background = Background(level, self.width, self.height, entities, camera)
-        self.foreground = Foreground(level, self.width, self.height, entities, camera)
-
-        for i in range(image.size[0]):
-            for j in range(image.size[1]):
-                if pixel[i, j][1] == 248:
-                    door = Door(player, pixel[i, j][0], pixel[i, j][2], (i * TILE_SIZE, j * TILE_SIZE), doors, entities, camera)
-                    self.entities.append(door)
-                    self.doors.append(door)
-                if pixel[i, j] == (128, 0, 255):
-                    gate = Gate(player, (i * TILE_SIZE, j * TILE_SIZE), objects, entities, camera)
-                    self.entities.append(gate)
-                    self.objects.append(gate)
-                if pixel[i, j] == (0, 0, 0):
-                    platform = Platform((i * TILE_SIZE, j * TILE_SIZE), platforms, entities, camera)
-                    self.entities.append(platform)
-                    self.platforms.append(platform)
-                if pixel[i, j] == (20, 20, 20):
-                    platform = Platform((i * TILE_SIZE, j * TILE_SIZE), platforms, entities, camera, type='upper')
-                    self.entities.append(platform)
-                    self.platforms.append(platform)
-                if pixel[i, j] == (255, 128, 0):
-                    enemy = Snake(player, platforms, enemies, objects, (i * TILE_SIZE, j * TILE_SIZE), enemies, entities, camera)
-                    self.entities.append(enemy)
-                    self.enemies.append(enemy)
-                if pixel[i, j] == (128, 64, 0):
-                    enemy = Rat(player, platforms, enemies, objects, (i * TILE_SIZE, j * TILE_SIZE), enemies, entities, camera)
-                    self.entities.append(enemy)
-                    self.enemies.append(enemy)
-                if pixel[i, j] == (255, 216, 0):
-                    item = Coin(player, platforms, (i * TILE_SIZE, j * TILE_SIZE), items, entities, camera)
-                    self.entities.append(item)
-                    self.items.append(item)
-                if pixel[i, j] == (0, 0, 255):
-                    item = Key(player, platforms, (i * TILE_SIZE, j * TILE_SIZE), items, entities, camera)
-                    self.entities.append(item)
-                    self.items.append(item)
-                if pixel[i, j] == (0, 255, 255):
-                    item = Diamond(player, platforms, (i * TILE_SIZE, j * TILE_SIZE), items, entities, camera)
-                    self.entities.append(item)
-                    self.items.append(item)
-                if pixel[i, j] == (255, 0, 0):
-                    item = Heart(player, platforms, (i * TILE_SIZE, j * TILE_SIZE), items, entities, camera)
-                    self.entities.append(item)
-                    self.items.append(item)
+        for i in range(width):
+            for j in range(height):
+                color = pixel[i, j]
+                value = GRID_COLORS.get(color)
+                if value:
+                    data.grid[j * width + i] = value
+                if color[1] == 248:
+                    data.spawns.append(('door', (i, j), (color[0], color[2])))
+                kind = SPAWN_COLORS.get(color)
+                if kind:
+                    data.spawns.append((kind, (i, j), None))
+    if os.path.isfile(background_path):
+        data.background = read_layer(background_path)
+    if os.path.isfile(foreground_path):
+        data.foreground = read_layer(foreground_path)
+    return data
+
+
+def source_stamp(path, checksum=False):
+    """
+    (mtime_ns, size, crc32) of a level source file, zeros if it doesn't
+    exist. The crc is only computed when asked for.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (0, 0, 0)
+    crc = 0
+    if checksum:
+        with open(path, 'rb') as f:
+            crc = zlib.crc32(f.read())
+    return (stat.st_mtime_ns, stat.st_size, crc)
+
+
+def write_level(path, data, stamps):
+    header = struct.pack('<4sHI', LEVEL_MAGIC, LEVEL_VERSION, LEVEL_TABLE_CRC)
+    for stamp in stamps:
+        header += struct.pack('<qQI', *stamp)
+    header += struct.pack('<HH', data.width, data.height)
+    body = [bytes(data.grid), struct.pack('<I', len(data.spawns))]
+    for kind, (i, j), door in data.spawns:
+        body.append(struct.pack('<BHHBB', SPAWN_KINDS.index(kind), i, j, *(door or (0, 0))))
+    for layer in (data.background, data.foreground):
+        if layer is None:
+            body.append(struct.pack('<HH', 0, 0))
+        else:
+            body.append(struct.pack('<HH', layer.width, layer.height))
+            body.append(bytes(layer.tiles))
+    # written to a temporary file that replaces the old one once complete,
+    # so an interrupted write never leaves a truncated level behind
+    fd, temp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + zlib.compress(b''.join(body)))
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def read_level_stamps(path):
+    """
+    The source stamps in a compiled level's header, or None if the file
+    is missing or was written by another version or colour tables.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(LEVEL_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(header) < LEVEL_HEADER_SIZE:
+        return None
+    magic, version, tables = struct.unpack_from('<4sHI', header)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION or tables != LEVEL_TABLE_CRC:
+        return None
+    return [struct.unpack_from('<qQI', header, 10 + 20 * n) for n in range(3)]
+
+
+def read_level(path):
+    with open(path, 'rb') as f:
+        contents = f.read()
+    width, height = struct.unpack_from('<HH', contents, LEVEL_HEADER_SIZE - 4)
+    body = zlib.decompress(contents[LEVEL_HEADER_SIZE:])
+    data = LevelData(width, height)
+    data.grid = bytearray(body[:width * height])
+    offset = width * height
+    count, = struct.unpack_from('<I', body, offset)
+    offset += 4
+    for _ in range(count):
+        kind, i, j, red, blue = struct.unpack_from('<BHHBB', body, offset)
+        offset += 7
+        kind = SPAWN_KINDS[kind]
+        data.spawns.append((kind, (i, j), (red, blue) if kind == 'door' else None))
+    layers = []
+    for _ in range(2):
+        layer_width, layer_height = struct.unpack_from('<HH', body, offset)
+        offset += 4
+        if layer_width and layer_height:
+            size = layer_width * layer_height
+            layers.append(TileLayer(layer_width, layer_height, bytearray(body[offset:offset + size])))
+            offset += size
+        else:
+            layers.append(None)
+    data.background, data.foreground = layers
+    return data
+
+
+def compiled_path(level):
+    return os.path.splitext(os.path.join("resources/images/levels", level))[0] + '.lvl'
+
+
+def load_level(level):
+    """
+    Return the LevelData for a level, from its compiled .lvl file when
+    that is up to date and by parsing the level images otherwise.
+
+    The compiled file is current when every source file's mtime and size
+    match the header or, failing that, its contents still hash the same.
+    A fresh compile is written next to the level image, if that fails
+    (e.g. a read only install) the parsed data is used as is. A compiled
+    file that can't be read is replaced the same way.
+    """
+    path = compiled_path(level)
+    sources = level_sources(level)
+    stamps = read_level_stamps(path)
+    if stamps is not None:
+        try:
+            current = [source_stamp(source) for source in sources]
+            if all(old[:2] == new[:2] for old, new in zip(stamps, current)):
+                return read_level(path)
+            current = [source_stamp(source, checksum=True) for source in sources]
+            if all(old[2] == new[2] for old, new in zip(stamps, current)):
+                data = read_level(path)
+                # only touched, store the new mtimes so the next load is quick
+                try:
+                    write_level(path, data, current)
+                except OSError:
+                    pass
+                return data
+        except (zlib.error, struct.error, ValueError, IndexError):
+            pass  # truncated or damaged, parse the level again
+    data = parse_level(level)
+    try:
+        write_level(path, data, [source_stamp(source, checksum=True) for source in sources])
+    except OSError:
+        pass
+    return data
+
 
+def compile_levels(directory="resources/images/levels"):
+    """(Re)compile every level image in the levels directory, returning their names."""
+    levels = sorted(name for name in os.listdir(directory) if name.endswith('.png'))
+    for level in levels:
+        load_level(level)
+    return levels
+
+
+def level_layers(data):
+    """ChunkedLayers for the background and foreground of a LevelData, None where a layer is missing."""
+    return tuple(ChunkedLayer(layer) if layer is not None else None
+                 for layer in (data.background, data.foreground))
+
+
+class ChunkedLayer(object):
+    """
+    A level layer split into square chunks of about LAYER_CHUNK_SIZE pixels.
+
+    Each chunk is rendered the first time it's drawn, or by build(), and
+    chunks without any tiles never get a Surface at all. Drawing only
+    touches the chunks on screen, so neither the memory nor the draw cost
+    of a layer grows with the size of the level.
+    """
+
+    def __init__(self, layer, chunk_size=LAYER_CHUNK_SIZE):
+        self.layer = layer
+        self.chunk_tiles = max(1, chunk_size // TILE_SIZE)
+        self.chunk_size = self.chunk_tiles * TILE_SIZE
+        self.columns = -(-layer.width // self.chunk_tiles)
+        self.rows = -(-layer.height // self.chunk_tiles)
+        self.chunks = {}  # (column, row) -> Surface, or None for an empty chunk
+        # what the chunks with tiles take once rendered, 32 bit pixels
+        self.bytes = 0
+        for row in range(self.rows):
+            for column in range(self.columns):
+                tiles = self.crop(column, row)
+                if any(tiles.tiles):
+                    self.bytes += tiles.width * tiles.height * TILE_SIZE * TILE_SIZE * 4
+
+    def crop(self, column, row):
+        return self.layer.crop(column * self.chunk_tiles, row * self.chunk_tiles,
+                               self.chunk_tiles, self.chunk_tiles)
+
+    def chunk(self, column, row):
+        key = (column, row)
+        if key not in self.chunks:
+            tiles = self.crop(column, row)
+            if any(tiles.tiles):
+                with profiler.section('level.layers'):
+                    self.chunks[key] = render_layer(tiles, LAYER_CACHE_DIR)
+                overlay.count_allocation()
+            else:
+                self.chunks[key] = None
+        return self.chunks[key]
+
+    def build(self, deadline=None):
+        """
+        Render every chunk now rather than when it's first drawn, or only
+        those there is time for before deadline, a time.perf_counter()
+        value. Returns whether every chunk is rendered.
+        """
+        for row in range(self.rows):
+            for column in range(self.columns):
+                if (column, row) not in self.chunks:
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        return False
+                    self.chunk(column, row)
+        return True
+
+    def draw(self, surface, offset):
+        """Blit the chunks that are on surface when the layer is drawn at offset."""
+        size = self.chunk_size
+        width, height = surface.get_size()
+        left = max(0, int(-offset[0]) // size)
+        top = max(0, int(-offset[1]) // size)
+        right = min(self.columns - 1, int(width - offset[0]) // size)
+        bottom = min(self.rows - 1, int(height - offset[1]) // size)
+        blits = []
+        for row in range(top, bottom + 1):
+            for column in range(left, right + 1):
+                chunk = self.chunk(column, row)
+                if chunk is not None:
+                    blits.append((chunk, pygame.Rect(column * size, row * size, size, size).move(offset)))
+        overlay.count_blits(len(blits))
+        return surface.blits(blits)
+
+    def memory(self):
+        """
+        Bytes of every chunk with tiles, rendered yet or not. Chunks are
+        rendered as they're drawn, counting only those would let a level
+        grow past the level cache budget after it was checked.
+        """
+        return self.bytes
+
+
+class LevelCache(object):
+    """
+    The levels of the world, built on demand by level number.
+
+    A level is built the first time it's needed. preload() queues the
+    layers of a level to be rendered ahead of time, a few chunks per
+    simulation step by build_pending(). Only the layers are prepared, the
+    entities are spawned when the level is entered so the simulation
+    doesn't depend on how far the preloading got.
+
+    Once the loaded levels' and preloaded layers take more than budget
+    bytes, first the least recently requested preloaded layers and then
+    the least recently visited levels are evicted, never the level being
+    played or the layers just asked for. What the player changed in them,
+    collected items, killed enemies and unlocked gates, is kept as one byte
+    per spawn and applied when the level is built again.
+    """
+
+    def __init__(self, names, player, budget=LEVEL_CACHE_BUDGET):
+        self.names = names
+        self.player = player
+        self.budget = budget
+        self.levels = collections.OrderedDict()  # least recently visited first
+        self.states = {}  # level number -> spawn states of an evicted level
+        self.data = [load_level(name) for name in names]
+        # level number -> preloaded layers waiting for the level to be
+        # built, least recently requested first
+        self.layers = collections.OrderedDict()
+        self.pending = []  # level numbers whose layers still have chunks to render
+        # door id -> (level number, door centre), when ids repeat the
+        # last door wins like the old search through every level did
+        self.doors = {}
+        for number, data in enumerate(self.data):
+            for kind, (i, j), door in data.spawns:
+                if kind == 'door':
+                    # doors are drawn two tiles square from their spawn point
+                    self.doors[door[0]] = (number, (i * TILE_SIZE + TILE_SIZE, j * TILE_SIZE + TILE_SIZE))
+
+    def get(self, number):
+        level = self.levels.get(number)
+        if level is None:
+            # chunks the preloading didn't get to are rendered on first draw
+            if number in self.pending:
+                self.pending.remove(number)
+            layers = self.layers.pop(number, None)
+            level = Level(self.names[number], self.player, self.data[number], layers,
+                          self.states.pop(number, None))
+            self.levels[number] = level
+            self.evict(number)
+        self.levels.move_to_end(number)
+        return level
+
+    def loaded(self):
+        return list(self.levels.values())
+
+    def memory(self):
+        return (sum(level.memory() for level in self.levels.values()) +
+                sum(layer.memory() for layers in self.layers.values() for layer in layers if layer is not None))
+
+    def evict(self, *keep):
+        """
+        Drop least recently requested preloaded layers, then least recently
+        visited levels, other than those numbered keep, until within budget.
+        """
+        for number in list(self.layers):
+            if self.memory() <= self.budget:
+                return
+            if number not in keep:
+                del self.layers[number]
+                if number in self.pending:
+                    self.pending.remove(number)
+        for number in list(self.levels):
+            if self.memory() <= self.budget:
+                return
+            if number not in keep:
+                self.states[number] = self.levels.pop(number).save_state()
+
+    def preload(self, number):
+        """Queue a level's layers to be rendered before the level is entered."""
+        if number in self.levels:
+            return
+        if number in self.layers:
+            self.layers.move_to_end(number)
+            return
+        self.layers[number] = level_layers(self.data[number])
+        self.pending.append(number)
+        # the level last gotten is the one being played
+        self.evict(number, next(reversed(self.levels), None))
+
+    def preload_door(self, door_id):
+        destination = self.doors.get(door_id)
+        if destination:
+            self.preload(destination[0])
+
+    def build_pending(self, seconds=PRELOAD_TIME):
+        """
+        Render chunks of the queued layers for up to seconds. Surfaces are
+        only ever made on the main thread, pygame isn't safe to use from others.
+        """
+        deadline = time.perf_counter() + seconds
+        while self.pending:
+            layers = self.layers[self.pending[0]]
+            if not all(layer is None or layer.build(deadline) for layer in layers):
+                return
+            self.pending.pop(0)
+
+
+class Level(object):
+    def __init__(self, level, player, data=None, layers=None, state=None):
+        """
+        data: the level's LevelData if it's already loaded
+        layers: its (background, foreground) ChunkedLayers if they're
+        already made
+        state: spawn states saved by save_state() when the level was last
+        unloaded
+        """
+        if data is None:
+            with profiler.section('level.parse'):
+                data = load_level(level)
+        if layers is None:
+            layers = level_layers(data)
+        self.width  = data.width * TILE_SIZE
+        self.height = data.height * TILE_SIZE
+        # entities is the render group the camera updates and draws
+        # while the player is in this level
+        self.entities  = pygame.sprite.Group()
+        self.enemies   = pygame.sprite.Group()
+        self.items     = pygame.sprite.Group()
+        self.doors     = pygame.sprite.Group()
+        self.objects   = pygame.sprite.Group()
+        self.grid = CollisionGrid(data.width, data.height, bytearray(data.grid))
+        self.spatial = SpatialHash()
+        self.background = Background(layers[0], self.width, self.height)
+        self.foreground = Foreground(layers[1], self.width, self.height)
+        self.spawns = [(kind, (i * TILE_SIZE, j * TILE_SIZE), door) for kind, (i, j), door in data.spawns]
+
+        with profiler.section('level.spawn'):
+            # the entity made from each spawn, None if it was gone already
+            self.spawned = []
+            for n, (kind, pos, data) in enumerate(self.spawns):
+                if state and state[n] == SPAWN_GONE:
+                    self.spawned.append(None)
+                    continue
+                entity = self.spawn(player, kind, pos, data)
+                if state and state[n] == SPAWN_OPEN:
+                    entity.set_opened()
+                    self.objects.remove(entity)
+                self.spawned.append(entity)
+            # entities settle their final rects after being added to the hash
+            self.spatial.refresh()
 
         # self.entities.append(player)
 
+    def spawn(self, player, kind, pos, data):
+        """Construct one entity from the level's spawn list."""
+        if kind == 'door':
+            return Door(player, data[0], data[1], pos, self.doors, self.entities, self.spatial)
+        elif kind == 'gate':
+            return Gate(player, pos, self.objects, self.entities, self.spatial)
+        elif kind == 'snake':
+            return Snake(player, self.grid, self.enemies, self.objects, pos, self.enemies, self.entities, self.spatial)
+        elif kind == 'rat':
+            return Rat(player, self.grid, self.enemies, self.objects, pos, self.enemies, self.entities, self.spatial)
+        elif kind == 'coin':
+            return Coin(player, pos, self.items, self.entities, self.spatial)
+        elif kind == 'key':
+            return Key(player, pos, self.items, self.entities, self.spatial)
+        elif kind == 'diamond':
+            return Diamond(player, pos, self.items, self.entities, self.spatial)
+        elif kind == 'heart':
+            return Heart(player, pos, self.items, self.entities, self.spatial)
+
+    def save_state(self):
+        """One byte per spawn recording whether it's gone or, for gates, open."""
+        state = bytearray(len(self.spawned))
+        for n, entity in enumerate(self.spawned):
+            if entity is None or not entity.alive():
+                state[n] = SPAWN_GONE
+            elif isinstance(entity, Gate) and not entity.locked:
+                state[n] = SPAWN_OPEN
+        return state
+
+    def memory(self):
+        """Bytes the level's layer chunks take once drawn, which dwarf everything else it holds."""
+        return self.background.memory() + self.foreground.memory()
+
+
+class CollisionGrid(object):
+    """
+    The solid tiles of a level stored as one byte per tile.
+
+    Movers look up only the handful of tiles their rect overlaps instead of
+    testing every platform in the level.
+    """
+
+    def __init__(self, width, height, tiles=None):
+        self.width = width
+        self.height = height
+        self.tiles = tiles if tiles is not None else bytearray(width * height)
+
+    def get(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.tiles[y * self.width + x]
+        return EMPTY
+
+    def set(self, x, y, value):
+        self.tiles[y * self.width + x] = value
+
+    def tile_rect(self, x, y, value, width=1, height=1):
+        # half-height tiles are only ever one tile tall
+        if value == UPPER:
+            return pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, width * TILE_SIZE, TILE_SIZE // 2)
+        return pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, width * TILE_SIZE, height * TILE_SIZE)
+
+    def collide_rects(self, rect):
+        """
+        Return the Rects of the solid tiles that intersect rect,
+        in the same column-major order the level is parsed in.
+        """
+        hits = []
+        left = max(rect.left // TILE_SIZE, 0)
+        right = min((rect.right - 1) // TILE_SIZE, self.width - 1)
+        top = max(rect.top // TILE_SIZE, 0)
+        bottom = min((rect.bottom - 1) // TILE_SIZE, self.height - 1)
+        tiles = self.tiles
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                value = tiles[y * self.width + x]
+                if value:
+                    tile = self.tile_rect(x, y, value)
+                    if tile.colliderect(rect):
+                        hits.append(tile)
+        return hits
+
+    def merge(self):
+        """
+        Greedily merge the solid tiles into as few axis-aligned rectangles
+        as possible. Runs of tiles are grown to the right first and then
+        downwards; half-height tiles only merge along their row.
+
+        Returns a list of (x, y, width, height, value) tuples in tiles.
+        Movers collide against the grid itself, benchmark.py compares the
+        two.
+        """
+        width = self.width
+        tiles = self.tiles
+        merged = bytearray(len(tiles))
+        rects = []
+        for y in range(self.height):
+            x = 0
+            while x < width:
+                value = tiles[y * width + x]
+                if not value or merged[y * width + x]:
+                    x += 1
+                    continue
+                end = x + 1
+                while end < width and tiles[y * width + end] == value and not merged[y * width + end]:
+                    end += 1
+                bottom = y + 1
+                if value == SOLID:
+                    while bottom < self.height:
+                        row = bottom * width
+                        if any(tiles[row + k] != value or merged[row + k] for k in range(x, end)):
+                            break
+                        bottom += 1
+                for j in range(y, bottom):
+                    for k in range(x, end):
+                        merged[j * width + k] = 1
+                rects.append((x, y, end - x, bottom - y, value))
+                x = end
+        return rects
+
+
+class SpatialHash(pygame.sprite.AbstractGroup):
+    """
+    A sprite group that also buckets its sprites into a uniform grid of
+    cells, so proximity queries only look at sprites in nearby cells.
+
+    Sprites that move must call move() afterwards to be rebucketed.
+    Killed sprites leave the hash like any other group.
+    """
+
+    def __init__(self, cell_size=TILE_SIZE * 4):
+        super().__init__()
+        self.cell_size = cell_size
+        self.cells = {}
+        self.sprite_cells = {}
+
+    def cell_keys(self, rect):
+        size = self.cell_size
+        return tuple((x, y)
+                     for x in range(rect.left // size, max(rect.right - 1, rect.left) // size + 1)
+                     for y in range(rect.top // size, max(rect.bottom - 1, rect.top) // size + 1))
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite)
+        sprite.spatial = self
+        self.insert(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if sprite.spatial is self:
+            sprite.spatial = None
+        self.discard(sprite)
+
+    def insert(self, sprite):
+        keys = self.cell_keys(sprite.rect)
+        self.sprite_cells[sprite] = keys
+        for key in keys:
+            # dicts keep the buckets in insertion order so queries are repeatable
+            self.cells.setdefault(key, {})[sprite] = None
+
+    def discard(self, sprite):
+        for key in self.sprite_cells.pop(sprite, ()):
+            cell = self.cells[key]
+            del cell[sprite]
+            if not cell:
+                del self.cells[key]
+
+    def move(self, sprite):
+        """Rebucket a sprite after its rect changed."""
+        if self.sprite_cells.get(sprite) != self.cell_keys(sprite.rect):
+            self.discard(sprite)
+            self.insert(sprite)
+
+    def refresh(self):
+        for sprite in self.sprites():
+            self.move(sprite)
+
+    def candidates(self, rect):
+        found = {}
+        cells = self.cells
+        for key in self.cell_keys(rect):
+            cell = cells.get(key)
+            if cell:
+                found.update(cell)
+        return found
+
+    def query_rect(self, rect, kind=None):
+        """Return the sprites (optionally of a given class) whose rect intersects rect."""
+        collide = rect.colliderect
+        return [s for s in self.candidates(rect)
+                if collide(s.rect) and (kind is None or isinstance(s, kind))]
+
+    def query_radius(self, pos, radius, kind=None):
+        """Return the sprites (optionally of a given class) whose center is within radius of pos."""
+        x, y = pos
+        area = pygame.Rect(int(x - radius), int(y - radius), int(radius * 2) + 1, int(radius * 2) + 1)
+        return [s for s in self.candidates(area)
+                if (kind is None or isinstance(s, kind))
+                and math.hypot(s.rect.centerx - x, s.rect.centery - y) <= radius]
+
+    def nearest(self, pos, kind=None, radius=TILE_SIZE * 8):
+        """Return the closest sprite of a given class within radius of pos, or None."""
+        x, y = pos
+        found = self.query_radius(pos, radius, kind)
+        if not found:
+            return None
+        return min(found, key=lambda s: math.hypot(s.rect.centerx - x, s.rect.centery - y))
+
 
 class Entity(pygame.sprite.Sprite):
     def __init__(self, color, pos, *groups):
@@ -638,17 +1887,20 @@ class Entity(pygame.sprite.Sprite):
         self.facing = None
         self.animations = {}
         self.offsets = {}
+        self.spatial = None  # the SpatialHash the sprite is bucketed in
+        self.prev_pos = None  # rect position before the last simulation step
+        self.frame_key = None  # (animation, frame, facing) of the image set by set_animation
 
-        self.__g = {}  # The groups the sprite is in
-        if groups:
-            self.add(*groups)
-
-        self.image = pygame.Surface((TILE_SIZE, TILE_SIZE))
-        self.image.fill(color)
+        # most entities replace this with an animation frame straight away
+        self.image = assets.placeholder(color)
         self.rect = self.image.get_rect(topleft=pos)
         self.imagerect = self.image.get_rect(topleft=pos)
         self.offset = pygame.Vector2(0, 0)
 
+        self.__g = {}  # The groups the sprite is in
+        if groups:
+            self.add(*groups)
+
     def add(self, *groups):
         """
         Add the sprite to groups
@@ -664,23 +1916,33 @@ class Entity(pygame.sprite.Sprite):
                     self.add_internal(group)
 
     def set_animation(self, key):
-        if self.facing == 'R':
-            self.image = pygame.transform.flip(self.animations[key].getCurrentFrame(), 1, 0)
-        if self.facing == 'L':
-            self.image = self.animations[key].getCurrentFrame()
-        self.offset = self.offsets[key][self.facing]
-        self.imagerect = self.image.get_rect(topleft=self.rect.topleft)
+        animation = self.animations[key]
+        frame = animation.currentFrameNum
+        # the image only needs replacing when the frame or facing changed,
+        # frames facing right are mirrored copies shared by the whole sheet
+        if self.frame_key != (key, frame, self.facing):
+            self.frame_key = (key, frame, self.facing)
+            if self.facing == 'R':
+                self.image = animation.getFlippedFrame(frame)
+            if self.facing == 'L':
+                self.image = animation.getFrame(frame)
+            self.offset = self.offsets[key][self.facing]
+            self.imagerect = self.image.get_rect(topleft=self.rect.topleft)
+        else:
+            self.imagerect.topleft = self.rect.topleft
 
 
 class Player(Entity):
-    def __init__(self, platforms, enemies, items, doors, objects, pos, *groups):
-        super().__init__(Color("#AAAAAA"), pos)
+    def __init__(self, pos, *groups):
+        super().__init__(Color("#AAAAAA"), pos, *groups)
         self.vel = pygame.Vector2((0, 0))
         self.onGround = False
-        self.platforms = platforms
-        self.enemies = enemies
-        self.items = items
-        self.doors = doors
+        # the current level's groups, set by GamePlay.change_level
+        self.grid = None
+        self.enemies = None
+        self.items = None
+        self.doors = None
+        self.objects = None
         self.speed = TILE_SIZE * 5 / 32
         self.jump_strength = math.sqrt(TILE_SIZE / 32) * 14
         self.facing = 'L'
@@ -699,18 +1961,18 @@ class Player(Entity):
         Sounds
         '''
         self.sounds = {}
-        self.sounds['step'] = [pygame.mixer.Sound('resources/sounds/entities/player/footstep00.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep01.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep02.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep03.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep04.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep05.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep06.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep07.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep08.ogg'),
-                               pygame.mixer.Sound('resources/sounds/entities/player/footstep09.ogg')]
-        self.sounds['attack'] = [pygame.mixer.Sound('resources/sounds/entities/player/attack1.wav')]
-        self.sounds['hit'] = [pygame.mixer.Sound('resources/sounds/entities/player/hit.wav')]
+        self.sounds['step'] = [soundbank.sound('resources/sounds/entities/player/footstep00.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep01.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep02.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep03.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep04.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep05.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep06.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep07.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep08.ogg'),
+                               soundbank.sound('resources/sounds/entities/player/footstep09.ogg')]
+        self.sounds['attack'] = [soundbank.sound('resources/sounds/entities/player/attack1.wav')]
+        self.sounds['hit'] = [soundbank.sound('resources/sounds/entities/player/hit.wav')]
 
         '''
         Animations
@@ -743,12 +2005,10 @@ class Player(Entity):
         self.rect.inflate_ip(-32, -4)
 
     def update(self):
-        dt = game.clock.tick(game.fps)
-
         if game.cutscene.in_progress:
             self.vel.x = 0
         if not game.cutscene.in_progress:
-            pressed = pygame.key.get_pressed()
+            pressed = game.inputs
 
             if self.health > 0:
                 if pressed[K_w]:
@@ -763,7 +2023,7 @@ class Player(Entity):
                             self.set_animation('jumping')
                     # doors logic
                     if door_hit_list:
-                        if door_hit_list[0] in game.state.level_list[game.state.current_level_number].doors:
+                        if door_hit_list[0] in game.state.current_level.doors:
                             if (door_hit_list[0].rect.centerx > self.rect.centerx and self.facing is 'R') or (door_hit_list[0].rect.centerx < self.rect.centerx and self.facing is 'L'):
                                 self.usedoor(door_hit_list[0])
 
@@ -800,10 +2060,9 @@ class Player(Entity):
                             self.set_animation('idle')
                 # run attacks
                 if self.attack_time != 0 or self.attack_combo_time != 0:
-                    self.attack(dt)
+                    self.attack()
                 # highlight closest gate in range for interaction
-                gates = [i for i in self.objects if
-                         type(i).__name__ is 'Gate' and spritedistance(i, self) <= TILE_SIZE * 2]
+                gates = [i for i in self.spatial.query_radius(self.rect.center, TILE_SIZE * 2, Gate) if i.locked]
                 if gates:
                     gates = sorted(gates, key=lambda e: spritedistance(e, self))
                     gates[0].selected = True
@@ -828,36 +2087,39 @@ class Player(Entity):
         # increment in x direction
         self.rect.left += self.vel.x
         # do x-axis collisions
-        self.collide(self.vel.x, 0, self.platforms)
+        self.collide(self.vel.x, 0, self.grid)
         self.collide(self.vel.x, 0, self.objects)
         # assuming the player is in the air
         self.onGround = False
         # increment in y direction
         self.rect.top += self.vel.y
         # do y-axis collisions
-        self.collide(0, self.vel.y, self.platforms)
+        self.collide(0, self.vel.y, self.grid)
+        # pick up any items the player is touching
+        for item in self.spatial.query_rect(self.rect, Item):
+            item.touch()
         # check damage and apply red tint
         if self.hurt_time > 0:
             self.red_tint()
 
     def collide(self, xvel, yvel, group):
-        collide_hit_list = pygame.sprite.spritecollide(self, group, False)
+        collide_hit_list = collide_rects(self.rect, group)
         for collision in collide_hit_list:
             if xvel > 0:
-                self.rect.right = collision.rect.left
+                self.rect.right = collision.left
             if xvel < 0:
-                self.rect.left = collision.rect.right
+                self.rect.left = collision.right
             if yvel > 0:
-                self.rect.bottom = collision.rect.top
+                self.rect.bottom = collision.top
                 self.onGround = True
                 self.vel.y = 0
                 if yvel > 5:
                     audioPlayback(self.sounds['step'])
             if yvel < 0:
-                self.rect.top = collision.rect.bottom
+                self.rect.top = collision.bottom
                 self.vel.y = 0
 
-    def attack(self, dt):
+    def attack(self):
         # animation logic
         if self.attack_time > 0:
             if self.attack_combo_time >= 0:
@@ -872,7 +2134,9 @@ class Player(Entity):
 
         # damage enemy logic
             if self.attack_time > 8:
-                enemy_hit_list = imagecollide(self, self.enemies)
+                # enemy images extend past their rects, so widen the search
+                nearby = self.spatial.query_rect(self.imagerect.inflate(TILE_SIZE * 4, TILE_SIZE * 4), Enemy)
+                enemy_hit_list = imagecollide(self, nearby)
                 for enemy in enemy_hit_list:
                     enemy.damage()
 
@@ -896,12 +2160,9 @@ class Player(Entity):
 
     def red_tint(self):
         self.hurt_time -= 1
-        _damage = self.image.copy().convert_alpha()
-        damage = _damage.copy().convert_alpha()
-        damage.fill((255, 0, 0), special_flags=pygame.BLEND_RGBA_MULT)
-        _damage.blit(damage, (0, 0))
         if self.hurt_time >= 15:
-            self.image = _damage
+            self.image = assets.tinted(self.image, (255, 0, 0))
+            self.frame_key = None
 
     def death(self):
         # play death animation
@@ -919,17 +2180,9 @@ class Player(Entity):
             game.state.music['gameover'].play()
 
     def usedoor(self, door):
-        destination_door  = None
-        destination_pos   = None
-        destination_level = None
-        doors = [i.doors for i in game.state.level_list]
-        for each_level in doors:
-            for dest_door in each_level:
-                if dest_door.id == door.travel_to_id:
-                    destination_door = dest_door
-        if destination_door:
-            destination_level = next(i for i, v in enumerate(game.state.level_list) if destination_door in v.doors)
-            destination_pos = destination_door.rect.center
+        destination = game.state.levels.doors.get(door.travel_to_id)
+        if destination:
+            destination_level, destination_pos = destination
             door.use(destination_level, destination_pos)
 
 
@@ -937,6 +2190,7 @@ class Platform(Entity):
     def __init__(self, pos, *groups, type='full'):
         super().__init__(Color("#DDDDDD"), pos, *groups)
 
+        self.image = self.image.copy()
         self.image.set_alpha(0)
 
         if type == 'upper':
@@ -957,12 +2211,12 @@ class Door(Entity):
         Sounds
         '''
         self.sounds = {}
-        self.sounds['open'] = [pygame.mixer.Sound("resources/sounds/entities/doors/open0.ogg"),
-                               pygame.mixer.Sound("resources/sounds/entities/doors/open1.ogg")]
-        self.sounds['close'] = [pygame.mixer.Sound("resources/sounds/entities/doors/close0.ogg"),
-                                pygame.mixer.Sound("resources/sounds/entities/doors/close1.ogg"),
-                                pygame.mixer.Sound("resources/sounds/entities/doors/close2.ogg"),
-                                pygame.mixer.Sound("resources/sounds/entities/doors/close3.ogg")]
+        self.sounds['open'] = [soundbank.sound("resources/sounds/entities/doors/open0.ogg"),
+                               soundbank.sound("resources/sounds/entities/doors/open1.ogg")]
+        self.sounds['close'] = [soundbank.sound("resources/sounds/entities/doors/close0.ogg"),
+                                soundbank.sound("resources/sounds/entities/doors/close1.ogg"),
+                                soundbank.sound("resources/sounds/entities/doors/close2.ogg"),
+                                soundbank.sound("resources/sounds/entities/doors/close3.ogg")]
 
         '''
         Animations
@@ -989,7 +2243,6 @@ class Door(Entity):
                     if game.cutscene.elapsed_time > 400:
                         audioPlayback(self.sounds['close'])
                         self.set_frame(0)
-                        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 2))
                         game.state.change_level(self.destination_level, self.destination_pos)
                         self.destination_level = None
                         self.destination_pos = None
@@ -1004,8 +2257,7 @@ class Door(Entity):
         game.cutscene.start(fadeout=200, fadein=200, fadeout_start=200, fadein_start=500)
 
     def set_frame(self, index):
-        self.image = self.animations['open'].getFrame(index)
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 2))
+        self.image = self.animations['open'].getScaledFrame(index, (TILE_SIZE * 2, TILE_SIZE * 2))
 
 
 class Gate(Entity):
@@ -1021,8 +2273,8 @@ class Gate(Entity):
         Sounds
         '''
         self.sounds = {}
-        self.sounds['unlock'] = [pygame.mixer.Sound("resources/sounds/entities/objects/gate_unlock.ogg")]
-        self.sounds['open'] = [pygame.mixer.Sound("resources/sounds/entities/objects/gate_open.ogg")]
+        self.sounds['unlock'] = [soundbank.sound("resources/sounds/entities/objects/gate_unlock.ogg")]
+        self.sounds['open'] = [soundbank.sound("resources/sounds/entities/objects/gate_open.ogg")]
 
         '''
         Animations
@@ -1034,8 +2286,7 @@ class Gate(Entity):
         self.animations['unlock'] = Animation("resources/images/tiles/gate_unlock.png", rows=1, cols=9, frameTime=75, loop=False)
         self.animations['open'] = Animation("resources/images/tiles/gate_open.png", rows=1, cols=8, frameTime=150, loop=False)
 
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE * 2, TILE_SIZE * 3))
         self.rect = self.image.get_rect(topleft=pos)
         self.rect = self.rect.inflate((int(-TILE_SIZE), 0))
         self.rect = self.rect.move((int(TILE_SIZE), 0))
@@ -1046,16 +2297,13 @@ class Gate(Entity):
             if self.player.key:
                 if self.selected:
                     if spritedistance(self, self.player) <= TILE_SIZE * 2:
-                        self.image = self.animations['interact'].getCurrentFrame()
-                        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+                        self.image = self.animations['interact'].getScaledCurrentFrame((TILE_SIZE * 2, TILE_SIZE * 3))
                     else:
                         self.selected = False
-                        self.image = self.animations['idle'].getCurrentFrame()
-                        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+                        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE * 2, TILE_SIZE * 3))
             else:
                 self.selected = False
-                self.image = self.animations['idle'].getCurrentFrame()
-                self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+                self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE * 2, TILE_SIZE * 3))
 
         if not self.locked:
             if not self.open:
@@ -1063,60 +2311,69 @@ class Gate(Entity):
                     if game.cutscene.in_progress:
                         if 0 < game.cutscene.elapsed_time < 200:
                             frnum = int((game.cutscene.elapsed_time / 200) * 9)
-                            self.image = self.animations['unlock'].getFrame(frnum)
-                            self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+                            self.image = self.animations['unlock'].getScaledFrame(frnum, (TILE_SIZE * 2, TILE_SIZE * 3))
                         if 200 < game.cutscene.elapsed_time < 450:
                             if not self.played_sound:
                                 audioPlayback(self.sounds['open'])
                                 self.played_sound = True
                             self.animations['open'].play()
                             frnum = int(((game.cutscene.elapsed_time - 200) / 250) * 8)
-                            self.image = self.animations['open'].getFrame(frnum)
-                            self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+                            self.image = self.animations['open'].getScaledFrame(frnum, (TILE_SIZE * 2, TILE_SIZE * 3))
                         if 450 < game.cutscene.elapsed_time < 500:
                             self.open = True
                             game.cutscene.end()
 
 
     def set_frame(self, animation, index):
-        self.image = self.animations[animation].getFrame(index)
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE * 2, TILE_SIZE * 3))
+        self.image = self.animations[animation].getScaledFrame(index, (TILE_SIZE * 2, TILE_SIZE * 3))
+
+    def set_opened(self):
+        """Show the gate as it is after being unlocked, for a rebuilt level."""
+        self.locked = False
+        self.open = True
+        self.set_frame('open', self.animations['open'].numFrames - 1)
 
     def unlock(self):
         self.locked = False
         self.animations['unlock'].play()
         audioPlayback(self.sounds['unlock'])
         game.cutscene.start(duration=500)
-        game.state.level_list[game.state.current_level_number].objects.remove(self)
+        game.state.current_level.objects.remove(self)
 
 
 class Layer(Entity):
-    def __init__(self, *groups):
+    def __init__(self, chunks, level_width, level_height, *groups):
         super().__init__(Color("#000000"), (0, 0), *groups)
+        # a ChunkedLayer, or None if the level has no such layer
+        self.chunks = chunks
+        self.rect = pygame.Rect(0, 0, level_width, level_height)
+
+    def draw(self, surface, offset):
+        """Blit the visible part of the layer, returning the blitted rects."""
+        if self.chunks is None:
+            return []
+        return self.chunks.draw(surface, offset)
+
+    def memory(self):
+        return self.chunks.memory() if self.chunks is not None else 0
 
 
 class Background(Layer):
-    def __init__(self, level, level_width, level_height, *groups):
-        super().__init__(*groups)
-        if os.path.isfile(os.path.join("resources/images/levels/background", level)):
-            self.image = build_layer(os.path.join("resources/images/levels/background", level))
-        self.rect = self.image.get_rect()
+    def __init__(self, chunks, level_width, level_height, *groups):
+        super().__init__(chunks, level_width, level_height, *groups)
 
 
 class Foreground(Layer):
-    def __init__(self, level, level_width, level_height, *groups):
-        super().__init__(*groups)
-        if os.path.isfile(os.path.join("resources/images/levels/foreground", level)):
-            self.image = build_layer(os.path.join("resources/images/levels/foreground", level))
-        self.rect = self.image.get_rect()
+    def __init__(self, chunks, level_width, level_height, *groups):
+        super().__init__(chunks, level_width, level_height, *groups)
 
 
 class Enemy(Entity):
-    def __init__(self, player, platforms, enemies, objects, pos, *groups):
+    def __init__(self, player, grid, enemies, objects, pos, *groups):
         super().__init__(Color("#FFFFFF"), pos, *groups)
         self.vel = pygame.Vector2((0, 0))
         self.onGround = False
-        self.platforms = platforms
+        self.grid = grid
         self.enemies = enemies
         self.player = player
         self.objects = objects
@@ -1129,24 +2386,24 @@ class Enemy(Entity):
         self.attack_time = 0
 
     def collide(self, xvel, yvel, group):
-        collide_hit_list = pygame.sprite.spritecollide(self, group, False)
+        collide_hit_list = collide_rects(self.rect, group)
         for collision in collide_hit_list:
             if xvel > 0:
-                self.rect.right = collision.rect.left
+                self.rect.right = collision.left
             if xvel < 0:
-                self.rect.left = collision.rect.right
+                self.rect.left = collision.right
             if yvel > 0:
-                self.rect.bottom = collision.rect.top
+                self.rect.bottom = collision.top
                 self.onGround = True
                 self.vel.y = 0
             if yvel < 0:
-                self.rect.top = collision.rect.bottom
+                self.rect.top = collision.bottom
                 self.vel.y = 0
 
     def chase(self):
         if game.cutscene.in_progress:
             self.vel.x = 0
-        if random.randint(1, 10) is 10 and not game.cutscene.in_progress:
+        if rng.stream('ai').randint(1, 10) is 10 and not game.cutscene.in_progress:
             if self.player.rect.x < self.rect.x:
                 self.vel.x = -self.speed
                 self.facing = 'L'
@@ -1180,20 +2437,17 @@ class Enemy(Entity):
 
     def red_tint(self):
         self.hurt_time -= 1
-        _damage = self.image.copy().convert_alpha()
-        damage = _damage.copy().convert_alpha()
-        damage.fill((255, 0, 0), special_flags=pygame.BLEND_RGBA_MULT)
-        _damage.blit(damage, (0, 0))
         if self.hurt_time >= 5:
-            self.image = _damage
+            self.image = assets.tinted(self.image, (255, 0, 0))
+            self.frame_key = None
 
     def death(self):
-        Particle('cloud.png', 250, 0.5, self.rect.center, (0, 0), game.state.entities, game.state.camera)
+        Particle('cloud.png', 250, 0.5, self.rect.center, (0, 0), game.state.current_level.entities)
 
 
 class Snake(Enemy):
-    def __init__(self, player, platforms, enemies, objects, pos, *groups):
-        super().__init__(player, platforms, enemies, objects, pos, *groups)
+    def __init__(self, player, grid, enemies, objects, pos, *groups):
+        super().__init__(player, grid, enemies, objects, pos, *groups)
         self.speed = TILE_SIZE * 2 / 32
         self.jump_strength = math.sqrt(TILE_SIZE / 32) * 10
         self.health = 4
@@ -1204,8 +2458,8 @@ class Snake(Enemy):
         Sounds
         '''
         self.sounds = {}
-        self.sounds['hit'] = [pygame.mixer.Sound("resources/sounds/entities/enemies/hit.wav")]
-        self.sounds['death'] = [pygame.mixer.Sound("resources/sounds/entities/enemies/snake_death.ogg")]
+        self.sounds['hit'] = [soundbank.sound("resources/sounds/entities/enemies/hit.wav")]
+        self.sounds['death'] = [soundbank.sound("resources/sounds/entities/enemies/snake_death.ogg")]
 
         '''
         Animations
@@ -1246,14 +2500,15 @@ class Snake(Enemy):
         # increment in x direction
         self.rect.left += self.vel.x
         # do x-axis collisions
-        self.collide(self.vel.x, 0, self.platforms)
+        self.collide(self.vel.x, 0, self.grid)
         self.collide(self.vel.x, 0, self.objects)
         # assuming the player is in the air
         self.onGround = False
         # increment in y direction
         self.rect.top += self.vel.y
         # do y-axis collisions
-        self.collide(0, self.vel.y, self.platforms)
+        self.collide(0, self.vel.y, self.grid)
+        self.spatial.move(self)
         # check damage and apply red tint
         if self.hurt_time > 0:
             self.red_tint()
@@ -1267,8 +2522,8 @@ class Snake(Enemy):
 
 
 class Rat(Enemy):
-    def __init__(self, player, platforms, enemies, objects, pos, *groups):
-        super().__init__(player, platforms, enemies, objects, pos, *groups)
+    def __init__(self, player, grid, enemies, objects, pos, *groups):
+        super().__init__(player, grid, enemies, objects, pos, *groups)
         self.speed = TILE_SIZE * 2 / 32
         self.jump_strength = math.sqrt(TILE_SIZE / 32) * 10
         self.health = 3
@@ -1279,8 +2534,8 @@ class Rat(Enemy):
         Sounds
         '''
         self.sounds = {}
-        self.sounds['hit'] = [pygame.mixer.Sound("resources/sounds/entities/enemies/hit.wav")]
-        self.sounds['death'] = [pygame.mixer.Sound("resources/sounds/entities/enemies/rat_death.ogg")]
+        self.sounds['hit'] = [soundbank.sound("resources/sounds/entities/enemies/hit.wav")]
+        self.sounds['death'] = [soundbank.sound("resources/sounds/entities/enemies/rat_death.ogg")]
 
         '''
         Animations
@@ -1319,14 +2574,15 @@ class Rat(Enemy):
         # increment in x direction
         self.rect.left += self.vel.x
         # do x-axis collisions
-        self.collide(self.vel.x, 0, self.platforms)
+        self.collide(self.vel.x, 0, self.grid)
         self.collide(self.vel.x, 0, self.objects)
         # assuming the player is in the air
         self.onGround = False
         # increment in y direction
         self.rect.top += self.vel.y
         # do y-axis collisions
-        self.collide(0, self.vel.y, self.platforms)
+        self.collide(0, self.vel.y, self.grid)
+        self.spatial.move(self)
         # check damage and apply red tint
         if self.hurt_time > 0:
             self.red_tint()
@@ -1340,29 +2596,27 @@ class Rat(Enemy):
 
 
 class Item(Entity):
-    def __init__(self, player, platforms, pos, *groups):
+    def __init__(self, player, pos, *groups):
         super().__init__(Color("#FFFFFF"), pos, *groups)
         self.vel = pygame.Vector2((0, 0))
         self.onGround = False
-        self.platforms = platforms
         self.player = player
         self.speed = 0
 
-    def update(self):
-        player_collision = pygame.sprite.collide_rect(self.player.rect, self.rect)
-        if player_collision:
-            self.pickup()
+    def touch(self):
+        # called by the player while it overlaps the item
+        self.pickup()
 
 
 class Coin(Item):
-    def __init__(self, player, platforms, pos, *groups):
-        super().__init__(player, platforms, pos, *groups)
+    def __init__(self, player, pos, *groups):
+        super().__init__(player, pos, *groups)
 
         '''
         Sounds
         '''
         self.sounds = {}
-        self.sounds['coin'] = [pygame.mixer.Sound("resources/sounds/entities/items/coin.wav")]
+        self.sounds['coin'] = [soundbank.sound("resources/sounds/entities/items/coin.wav")]
 
         '''
         Animations
@@ -1371,33 +2625,28 @@ class Coin(Item):
         self.animations['idle'] = Animation("resources/images/entities/coin.png", rows=9, cols=1, frameTime=100)
         self.animations['idle'].play()
 
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
     def update(self):
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
-        player_collision = pygame.sprite.collide_rect(self, self.player)
-        if player_collision:
-            self.pickup()
 
     def pickup(self):
         self.player.score += 10
         audioPlayback(self.sounds['coin'])
-        Particle('star.png', 40, 1, self.pos, (0, 0), game.state.entities, game.state.camera)
+        Particle('star.png', 40, 1, self.pos, (0, 0), game.state.current_level.entities)
         self.kill()
 
 
 class Key(Item):
-    def __init__(self, player, platforms, pos, *groups):
-        super().__init__(player, platforms, pos, *groups)
+    def __init__(self, player, pos, *groups):
+        super().__init__(player, pos, *groups)
 
         '''
         Sounds
         '''
         self.sounds = {}
-        self.sounds['key'] = [pygame.mixer.Sound("resources/sounds/entities/items/key.wav")]
+        self.sounds['key'] = [soundbank.sound("resources/sounds/entities/items/key.wav")]
 
         '''
         Animations
@@ -1406,32 +2655,27 @@ class Key(Item):
         self.animations['idle'] = Animation("resources/images/entities/key.png", rows=1, cols=1, frameTime=100)
         self.animations['idle'].play()
 
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
     def update(self):
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
-        player_collision = pygame.sprite.collide_rect(self, self.player)
-        if player_collision:
-            self.pickup()
 
     def pickup(self):
         self.player.key = True
         audioPlayback(self.sounds['key'])
-        Particle('star.png', 40, 1, self.pos, (0, 0), game.state.entities, game.state.camera)
+        Particle('star.png', 40, 1, self.pos, (0, 0), game.state.current_level.entities)
         self.kill()
 
 
 class Heart(Item):
-    def __init__(self, player, platforms, pos, *groups):
-        super().__init__(player, platforms, pos, *groups)
+    def __init__(self, player, pos, *groups):
+        super().__init__(player, pos, *groups)
         '''
         Sounds
         '''
         self.sounds = {}
-        self.sounds['health'] = [pygame.mixer.Sound("resources/sounds/entities/items/heart.wav")]
+        self.sounds['health'] = [soundbank.sound("resources/sounds/entities/items/heart.wav")]
 
         '''
         Animations
@@ -1440,17 +2684,15 @@ class Heart(Item):
         self.animations['idle'] = Animation("resources/images/entities/heart.png", rows=6, cols=1, frameTime=120)
         self.animations['idle'].play()
 
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
     def update(self):
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE, TILE_SIZE))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE, TILE_SIZE))
 
-        player_collision = pygame.sprite.collide_rect(self, self.player)
-        if player_collision:
-            if self.player.health < 13:
-                self.pickup()
+
+    def touch(self):
+        if self.player.health < 13:
+            self.pickup()
 
     def pickup(self):
         if self.player.health <= 11:
@@ -1458,13 +2700,13 @@ class Heart(Item):
         elif self.player.health == 12:
             self.player.health = 13
         audioPlayback(self.sounds['health'])
-        Particle('health.png', 40, 1, self.pos, (0, 0), game.state.entities, game.state.camera)
+        Particle('health.png', 40, 1, self.pos, (0, 0), game.state.current_level.entities)
         self.kill()
 
 
 class Diamond(Item):
-    def __init__(self, player, platforms, pos, *groups):
-        super().__init__(player, platforms, pos, *groups)
+    def __init__(self, player, pos, *groups):
+        super().__init__(player, pos, *groups)
 
         '''
         Animations
@@ -1473,16 +2715,11 @@ class Diamond(Item):
         self.animations['idle'] = Animation("resources/images/entities/diamond.png", rows=4, cols=1, frameTime=200)
         self.animations['idle'].play()
 
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE*2, TILE_SIZE*2))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE*2, TILE_SIZE*2))
 
     def update(self):
-        self.image = self.animations['idle'].getCurrentFrame()
-        self.image = pygame.transform.scale(self.image, (TILE_SIZE*2, TILE_SIZE*2))
+        self.image = self.animations['idle'].getScaledCurrentFrame((TILE_SIZE*2, TILE_SIZE*2))
 
-        player_collision = pygame.sprite.collide_rect(self, self.player)
-        if player_collision:
-            self.pickup()
 
     def pickup(self):
         game.state.win = True
@@ -1498,8 +2735,6 @@ class Particle(Entity):
         self.size = size
         self.elapsed = 0
 
-        game.state.level_list[game.state.current_level_number].entities.append(self)
-
         '''
         Animations
         '''
@@ -1507,15 +2742,13 @@ class Particle(Entity):
         self.animations['idle'] = Animation(os.path.join("resources/images/particles", particle), rows=8, cols=1, frameTime=speed, loop=False)
         self.animations['idle'].play()
 
-        self.image = self.animations['idle'].getCurrentFrame()
         newsize = int(TILE_SIZE * self.size)
-        self.image = pygame.transform.scale(self.image, (newsize, newsize))
+        self.image = self.animations['idle'].getScaledCurrentFrame((newsize, newsize))
 
     def update(self):
 
-        self.image = self.animations['idle'].getCurrentFrame()
         newsize = int(TILE_SIZE * self.size)
-        self.image = pygame.transform.scale(self.image, (newsize, newsize))
+        self.image = self.animations['idle'].getScaledCurrentFrame((newsize, newsize))
 
         if self.animations['idle'].isFinished():
             self.kill()
@@ -1537,9 +2770,268 @@ def imagecollide(sprite, group):
     return [s for s in group if imagecollide(s.imagerect) and s is not sprite]
 
 
+def collide_rects(rect, group):
+    """
+    Find the Rects of the solid tiles in a CollisionGrid, or of the Sprites
+    in a Group, that intersect rect
+    """
+    with profiler.section('collision'):
+        if isinstance(group, CollisionGrid):
+            return group.collide_rects(rect)
+        collide = rect.colliderect
+        return [s.rect for s in group if collide(s.rect)]
+
+
 def spritedistance(sprite, object):
     return math.hypot(sprite.rect.centerx - object.rect.centerx, sprite.rect.centery - object.rect.centery)
 
+def load_sprite_sheet(filename, rows, cols):
+    # Slices a sprite sheet into a list of converted Surface objects,
+    # one per frame, reading left to right and top to bottom.
+    rects = []
+    image = pygame.image.load(filename)
+
+    sprite_width = image.get_width() // cols
+    sprite_height = image.get_height() // rows
+
+    for y in range(0, image.get_height(), sprite_height):
+        if y + sprite_height > image.get_height():
+            continue
+        for x in range(0, image.get_width(), sprite_width):
+            if x + sprite_width > image.get_width():
+                continue
+
+            rects.append((x, y, sprite_width, sprite_height))
+
+    # create a list of Surface objects from the sprite sheet
+    surfaces = []
+    for rect in rects:
+        surf = pygame.Surface((rect[2], rect[3]), 0, image).convert()
+        surf.set_colorkey((63, 114, 107))  # background color to turn transparent
+        surf.blit(image, (0, 0), rect, pygame.BLEND_RGBA_ADD)
+        surfaces.append(surf)
+    return surfaces
+
+
+def tint_surface(surface, color):
+    # blends a color multiplied copy of a surface over it
+    tinted = surface.copy().convert_alpha()
+    tint = tinted.copy()
+    tint.fill(color, special_flags=pygame.BLEND_RGBA_MULT)
+    tinted.blit(tint, (0, 0))
+    return tinted
+
+
+def surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class AssetCache(object):
+    """
+    Process-wide registry of decoded images, sprite sheets and fonts.
+
+    Each asset is decoded once, keyed by (kind, path, rows, cols, size, flags),
+    and the same Surface/Font objects are handed out to every caller after
+    that. The returned Surfaces are shared, so callers must copy them before
+    drawing onto them.
+    """
+
+    def __init__(self):
+        self._assets = {}
+        self._sources = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    def provide(self, path, data):
+        """
+        Serve the contents of a file from memory instead of from disk,
+        e.g. images generated on the fly. Only affects assets not yet loaded.
+        """
+        self._sources[path] = data
+
+    def open(self, path):
+        """A file object for a provided path, the path itself otherwise."""
+        data = self._sources.get(path)
+        return io.BytesIO(data) if data is not None else path
+
+    def _fetch(self, key, loader):
+        asset = self._assets.get(key)
+        if asset is not None:
+            self.hits += 1
+            return asset
+        self.misses += 1
+        with profiler.section('assets.load'):
+            asset = loader()
+        self._assets[key] = asset
+        if isinstance(asset, pygame.Surface):
+            self.bytes += surface_bytes(asset)
+            overlay.count_allocation()
+        elif isinstance(asset, tuple):
+            self.bytes += sum(surface_bytes(i) for i in asset)
+            overlay.count_allocation(len(asset))
+        return asset
+
+    def image(self, path, size=None, flags='convert'):
+        """
+        Return a shared image Surface.
+
+        size: optional (width, height) to scale the image to
+        flags: 'convert', 'convert_alpha' or None to keep the file's format
+        """
+        def load():
+            image = pygame.image.load(self.open(path), path)
+            if flags == 'convert':
+                image = image.convert()
+            elif flags == 'convert_alpha':
+                image = image.convert_alpha()
+            if size:
+                image = pygame.transform.scale(image, size)
+            return image
+        return self._fetch(('image', path, None, None, size, flags), load)
+
+    def sheet(self, path, rows, cols, size=None, flip=False):
+        """
+        Return the frames of a sprite sheet as a shared tuple of Surfaces.
+
+        size: optional (width, height) to scale every frame to
+        flip: mirror every frame horizontally
+        """
+        if flip:
+            return self._fetch(('sheet', path, rows, cols, size and tuple(size), 'flip'),
+                               lambda: tuple(pygame.transform.flip(frame, 1, 0)
+                                             for frame in self.sheet(path, rows, cols, size)))
+        if size:
+            return self._fetch(('sheet', path, rows, cols, tuple(size), None),
+                               lambda: tuple(pygame.transform.scale(frame, size)
+                                             for frame in self.sheet(path, rows, cols)))
+        return self._fetch(('sheet', path, rows, cols, None, None),
+                           lambda: tuple(load_sprite_sheet(self.open(path), rows, cols)))
+
+    def tinted(self, surface, color):
+        """
+        Return a shared copy of a Surface with color multiplied over it,
+        the way the damage flash draws it. Only for Surfaces that are never
+        drawn onto, like animation frames, the result is cached per Surface.
+        """
+        return self._fetch(('tint', surface, None, None, None, tuple(color)),
+                           lambda: tint_surface(surface, color))
+
+    def placeholder(self, color):
+        """Return a shared tile sized Surface filled with color."""
+        def make():
+            surface = pygame.Surface((TILE_SIZE, TILE_SIZE))
+            surface.fill(color)
+            return surface
+        return self._fetch(('placeholder', None, None, None, None, tuple(Color(color))), make)
+
+    def font(self, path, size):
+        """Return a shared Font object."""
+        return self._fetch(('font', path, None, None, size, None),
+                           lambda: pygame.font.Font(self.open(path), size))
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._assets),
+                'bytes': self.bytes}
+
+    def clear(self):
+        self._assets = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+
+assets = AssetCache()
+
+
+class TextCache(object):
+    """
+    Rendered text shared between the HUD, buttons and menus.
+
+    Strings are rasterized once per (font, size, text, antialias, color) and
+    kept in least recently used order, up to max_entries. Numbers are put
+    together from a per font glyph atlas of the digits instead, so a
+    changing score never goes through the font rasterizer.
+    """
+
+    def __init__(self, max_entries=TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._text = collections.OrderedDict()
+        self._atlases = {}
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, path, size, text, antialias=True, color="white"):
+        """Return a shared Surface of text, callers must not draw onto it."""
+        color = tuple(pygame.Color(color))
+        key = (path, size, text, antialias, color)
+        surface = self._text.get(key)
+        if surface is not None:
+            self.hits += 1
+            self._text.move_to_end(key)
+            return surface
+        self.misses += 1
+        with profiler.section('text.render'):
+            surface = assets.font(path, size).render(text, antialias, color)
+        overlay.count_allocation()
+        self._text[key] = surface
+        if len(self._text) > self.max_entries:
+            self._text.popitem(last=False)
+        return surface
+
+    def atlas(self, path, size, antialias=True, color="white"):
+        """
+        Return the digits rendered side by side and the area of each digit
+        in it, made once per font, size and color.
+        """
+        color = tuple(pygame.Color(color))
+        key = (path, size, antialias, color)
+        atlas = self._atlases.get(key)
+        if atlas is None:
+            font = assets.font(path, size)
+            glyphs = [font.render(digit, antialias, color) for digit in DIGITS]
+            surface = pygame.Surface((sum(glyph.get_width() for glyph in glyphs),
+                                      max(glyph.get_height() for glyph in glyphs)), pygame.SRCALPHA)
+            areas = {}
+            x = 0
+            for digit, glyph in zip(DIGITS, glyphs):
+                surface.blit(glyph, (x, 0))
+                areas[digit] = pygame.Rect(x, 0, glyph.get_width(), glyph.get_height())
+                x += glyph.get_width()
+            atlas = self._atlases[key] = (surface, areas)
+        return atlas
+
+    def number(self, path, size, value, digits=0, antialias=True, color="white"):
+        """
+        Return a new Surface with value zero padded to digits, blitted
+        together from the glyph atlas at the pen positions of the font.
+        """
+        text = str(value).zfill(digits)
+        font = assets.font(path, size)
+        atlas, areas = self.atlas(path, size, antialias, color)
+        surface = pygame.Surface(font.size(text), pygame.SRCALPHA)
+        overlay.count_allocation()
+        surface.blits([(atlas, (font.size(text[:n])[0], 0), areas[digit])
+                       for n, digit in enumerate(text)], False)
+        return surface
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._text),
+                'atlases': len(self._atlases)}
+
+    def clear(self):
+        self._text = collections.OrderedDict()
+        self._atlases = {}
+        self.hits = 0
+        self.misses = 0
+
+
+textcache = TextCache()
+
 
 class Animation(object):
     def __init__(self, filename, rows=None, cols=None, frameTime=100, loop=True):
@@ -1559,6 +3051,11 @@ class Animation(object):
 
         # create animation frames from sprite sheet
         frames = self.getImagesFromSpriteSheet(filename, rows=rows, cols=cols, frameTime=frameTime)
+        # the sheet the frames came from, for looking up its scaled frames
+        self._sheet = (filename, rows, cols)
+        self._reversed = False
+        # shared tuples of scaled and mirrored frames, see getVariantFrame()
+        self._variantImages = {}
 
         # _images stores the pygame.Surface objects of each frame
         self._images = []
@@ -1603,38 +3100,15 @@ class Animation(object):
         del frames
 
     def getImagesFromSpriteSheet(self, filename, rows=None, cols=None, frameTime=100):
-        rects = []
-        image = pygame.image.load(filename)
-
-        sprite_width = image.get_width() // cols
-        sprite_height = image.get_height() // rows
-
-        for y in range(0, image.get_height(), sprite_height):
-            if y + sprite_height > image.get_height():
-                continue
-            for x in range(0, image.get_width(), sprite_width):
-                if x + sprite_width > image.get_width():
-                    continue
-
-                rects.append((x, y, sprite_width, sprite_height))
-
-        # create a list of Surface objects from the sprite sheet
-        surfaces = []
-        for rect in rects:
-            surf = pygame.Surface((rect[2], rect[3]), 0, image).convert()
-            surf.set_colorkey((63, 114, 107))  # background color to turn transparent
-            surf.blit(image, (0, 0), rect, pygame.BLEND_RGBA_ADD)
-            surfaces.append(surf)
-        frames = list(map(lambda i: (i, frameTime), surfaces))
-        del image
-        del sprite_width
-        del sprite_height
-        del rects
-        return frames
+        # the decoded frames are shared with every other Animation built
+        # from the same sprite sheet, see AssetCache.sheet()
+        surfaces = assets.sheet(filename, rows, cols)
+        return list(map(lambda i: (i, frameTime), surfaces))
 
     def reverse(self):
         # Reverses the order of the frames.
         self.elapsed = (self._durations[-1] + self._startTimes[-1]) - self.elapsed
+        self._reversed = not self._reversed
         self._images.reverse()
         self._transformedImages.reverse()
         self._durations.reverse()
@@ -1663,6 +3137,9 @@ class Animation(object):
             newAnim._durations = self._durations[:]
             newAnim._startTimes = self._startTimes[:]
             newAnim.numFrames = self.numFrames
+            newAnim._sheet = self._sheet
+            newAnim._reversed = self._reversed
+            newAnim._variantImages = {}
             retval.append(newAnim)
         return retval
 
@@ -1700,6 +3177,38 @@ class Animation(object):
         # version of the frame, it will return that one.
         return self.getFrame(self.currentFrameNum)
 
+    def getVariantFrame(self, frameNum, size=None, flip=False):
+        # Returns the frameNum-th frame scaled to size (width, height) and/or
+        # mirrored horizontally. The variant frames are made once per sprite
+        # sheet and shared with every other Animation of that sheet through
+        # the AssetCache. Transformed frames can't be shared and are scaled
+        # and flipped on every call.
+        if self._transformedImages != []:
+            frame = self.getFrame(frameNum)
+            if size:
+                frame = pygame.transform.scale(frame, size)
+                overlay.count_allocation()
+            if flip:
+                frame = pygame.transform.flip(frame, 1, 0)
+                overlay.count_allocation()
+            return frame
+        frames = self._variantImages.get((size, flip))
+        if frames is None:
+            frames = assets.sheet(self._sheet[0], self._sheet[1], self._sheet[2], size=size, flip=flip)
+            self._variantImages[(size, flip)] = frames
+        if self._reversed:
+            frameNum = self.numFrames - 1 - frameNum
+        return frames[frameNum]
+
+    def getScaledFrame(self, frameNum, size):
+        return self.getVariantFrame(frameNum, size=size)
+
+    def getScaledCurrentFrame(self, size):
+        return self.getVariantFrame(self.currentFrameNum, size=size)
+
+    def getFlippedFrame(self, frameNum):
+        return self.getVariantFrame(frameNum, flip=True)
+
     def clearTransforms(self):
         # Deletes all the transformed frames so that the animation object
         # displays the original Surfaces/images as they were before
@@ -2156,7 +3665,117 @@ def findStartTime(startTimes, target):
 def audioPlayback(sounds):
     for i in sounds:
         i.set_volume(VOLUME)
-    random.choice(sounds).play()
+    rng.stream('audio').choice(sounds).play()
+
+
+class LazySound(object):
+    """
+    Handle to a sample in the SoundBank. The sample is only decoded the
+    first time it is played (or otherwise used), every other call is
+    forwarded to the shared pygame.mixer.Sound.
+    """
+
+    def __init__(self, bank, path):
+        self.bank = bank
+        self.path = path
+        self._sound = None
+        self._volume = None
+
+    def get(self):
+        if self._sound is None:
+            self._sound = self.bank.decode(self.path)
+            if self._volume is not None:
+                self._sound.set_volume(self._volume)
+        return self._sound
+
+    def is_decoded(self):
+        return self._sound is not None
+
+    def set_volume(self, value):
+        # volume changes do not force a decode
+        if self._sound is None:
+            self._volume = value
+        else:
+            self._sound.set_volume(value)
+
+    def play(self, *args, **kwargs):
+        return self.get().play(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class SoundBank(object):
+    """
+    Process-wide registry of sound samples.
+
+    Every path is decoded at most once and the resulting sample is shared by
+    all entities that use it. With lazy=True (the default) decoding is
+    deferred until a sample is first played.
+    """
+
+    def __init__(self, lazy=True):
+        self.lazy = lazy
+        self._sounds = {}
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+        self.bytes = 0
+        self.load_time = 0.0
+
+    def sound(self, path):
+        """Return the shared LazySound for a file path."""
+        sound = self._sounds.get(path)
+        if sound is not None:
+            self.hits += 1
+            return sound
+        self.misses += 1
+        sound = LazySound(self, path)
+        self._sounds[path] = sound
+        if not self.lazy:
+            sound.get()
+        return sound
+
+    def decode(self, path):
+        start = time.perf_counter()
+        with profiler.section('sounds.decode'):
+            sound = pygame.mixer.Sound(assets.open(path))
+        self.load_time += time.perf_counter() - start
+        self.decoded += 1
+        self.bytes += sound_bytes(sound)
+        return sound
+
+    def preload(self):
+        """Decode every sample that has been requested so far."""
+        for sound in list(self._sounds.values()):
+            sound.get()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'decoded': self.decoded,
+                'bytes': self.bytes,
+                'load_time': self.load_time}
+
+    def clear(self):
+        self._sounds = {}
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+        self.bytes = 0
+        self.load_time = 0.0
+
+
+def sound_bytes(sound):
+    # size of the decoded sample in mixer format
+    mixer = pygame.mixer.get_init()
+    if not mixer:
+        return 0
+    frequency, size, channels = mixer
+    return int(sound.get_length() * frequency) * channels * (abs(size) // 8)
+
+
+soundbank = SoundBank()
 
 
 class Options(GameState):
@@ -2188,7 +3807,7 @@ class OptionsHandler(Options):
                              }
         self.reset()
 
-        self.background = pygame.image.load(os.path.join("resources/images/gui", "options_background.png")).convert()
+        self.background = assets.image(os.path.join("resources/images/gui", "options_background.png"))
 
     def update(self):
         if self.stack:
@@ -2225,11 +3844,10 @@ class Button(object):
         self.type = None
         self.pos = pos
         self.text = text
-        self.font = pygame.font.Font(os.path.join("resources/font", "boxy_bold.ttf"), 16)
-        self.title = self.font.render(self.text, True, pygame.Color("white"))
-        self.sound = [pygame.mixer.Sound(os.path.join("resources/sounds/ui", "button_press.wav"))]
-        self.inactive = pygame.image.load(os.path.join("resources/images/gui", "button_inactive.png")).convert()
-        self.active = pygame.image.load(os.path.join("resources/images/gui", "button_active.png")).convert()
+        self.title = textcache.render(os.path.join("resources/font", "boxy_bold.ttf"), 16, self.text)
+        self.sound = [soundbank.sound(os.path.join("resources/sounds/ui", "button_press.wav"))]
+        self.inactive = assets.image(os.path.join("resources/images/gui", "button_inactive.png"))
+        self.active = assets.image(os.path.join("resources/images/gui", "button_active.png"))
         self.name = name
         self.type = None
         self.call_directory_name = None
@@ -2257,8 +3875,8 @@ class Button(object):
 
 
     def get_event(self):
-        mouse = pygame.mouse.get_pos()
-        click = pygame.mouse.get_pressed()
+        mouse = game.inputs.mouse_pos
+        click = game.inputs.mouse_pressed
 
         if self.pos[0] < mouse[0] < self.pos[0] + self.rect.w and self.pos[1] < mouse[1] < self.pos[1] + self.rect.h:
             self.hover = True
@@ -2291,14 +3909,88 @@ class Button(object):
         surface.blit(self.title, tuple(map(sum, zip(self.title_rect, self.pos))))
 
 
-if __name__ == "__main__":
-    os.environ['SDL_VIDEO_CENTERED'] = '1'
-    pygame.init()
-    screen = pygame.display.set_mode(SCREEN_SIZE.size, HWSURFACE | DOUBLEBUF | RESIZABLE)
+def seed_type(value):
+    # replays store the seed as an unsigned 32 bit int
+    seed = int(value)
+    if not 0 <= seed < 2 ** 32:
+        raise argparse.ArgumentTypeError("seed must be between 0 and %d" % (2 ** 32 - 1))
+    return seed
+
+
+def create_game(headless=False, start_state="MENU", seed=0):
+    """
+    Initialise pygame and build the global game and options objects.
+
+    headless: use SDL's dummy video and audio drivers so no window
+    or audio device is needed
+    seed: seed for the random streams, runs with the same seed and
+    the same input are identical
+    """
+    global game, options
+    rng.seed(seed)
+    sim_clock.reset()
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        pygame.init()
+        screen = pygame.display.set_mode(SCREEN_SIZE.size)
+    else:
+        os.environ['SDL_VIDEO_CENTERED'] = '1'
+        pygame.init()
+        screen = pygame.display.set_mode(SCREEN_SIZE.size, HWSURFACE | DOUBLEBUF | RESIZABLE)
     options = OptionsHandler()
     states = {"MENU": Menu(),
                 "GAMEPLAY": GamePlay()}
-    game = Game(screen, states, "MENU")
-    game.run()
+    game = Game(screen, states, start_state, headless=headless)
+    return game
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pixel Knight")
+    parser.add_argument('--headless', action='store_true',
+                        help="run the gameplay simulation without a window as fast as possible")
+    parser.add_argument('--ticks', type=int, default=3600,
+                        help="number of simulation steps to run in headless mode")
+    parser.add_argument('--render', action='store_true',
+                        help="also draw every step in headless mode")
+    parser.add_argument('--seed', type=seed_type, default=None,
+                        help="seed for the random streams (random by default)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record every step's input to FILE")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="play back the input recorded in FILE")
+    parser.add_argument('--compile-levels', action='store_true',
+                        help="compile every level image to a .lvl file and exit")
+    args = parser.parse_args()
+    if args.compile_levels:
+        for level in compile_levels():
+            print("compiled %s" % compiled_path(level))
+        sys.exit()
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+
+    if args.replay:
+        replay = InputReplay(args.replay)
+        game = create_game(headless=args.headless, start_state=replay.start_state, seed=replay.seed)
+        game.input = replay
+        if args.headless:
+            tps = game.simulate(len(replay.frames), render=args.render)
+            print("%d ticks at %.1f ticks/second (%.1fx real time)" % (len(replay.frames), tps, tps / TICK_RATE))
+        else:
+            game.run()
+        print("checksum %08x" % game.states["GAMEPLAY"].checksum())
+    elif args.headless:
+        start_state = "GAMEPLAY"
+        game = create_game(headless=True, start_state=start_state, seed=seed)
+        if args.record:
+            game.input = InputRecorder(game.input, seed, start_state)
+        tps = game.simulate(args.ticks, render=args.render)
+        print("%d ticks at %.1f ticks/second (%.1fx real time)" % (args.ticks, tps, tps / TICK_RATE))
+    else:
+        game = create_game(seed=seed)
+        if args.record:
+            game.input = InputRecorder(game.input, seed, game.state_name)
+        game.run()
+    if args.record:
+        game.input.save(args.record)
     pygame.quit()
     sys.exit()
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pytest
+
+pygame = pytest.importorskip('pygame')
+from PIL import Image  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run  # noqa: E402
+import benchmark  # noqa: E402
+
+WIDTH, HEIGHT = 12, 6
+TILE = next(color for color in run.TILE_DICT if len(color) == 4)
+# the gate's sprite sheets, a row of frames each
+GATE_SHEETS = {"resources/images/tiles/gate_locked.png": 1,
+               "resources/images/tiles/gate_interact.png": 2,
+               "resources/images/tiles/gate_unlock.png": 9,
+               "resources/images/tiles/gate_open.png": 8}
+GATE_SOUNDS = ["resources/sounds/entities/objects/gate_unlock.ogg",
+               "resources/sounds/entities/objects/gate_open.ogg"]
+
+
+@pytest.fixture(scope='module')
+def headless():
+    """A dummy display and generated stand-ins for the images and sounds the levels load."""
+    benchmark.init_headless()
+    benchmark.provide_resources()
+    for path, frames in GATE_SHEETS.items():
+        run.assets.provide(path, benchmark.png_bytes(pygame.Surface((32 * frames, 48))))
+    for path in GATE_SOUNDS:
+        run.assets.provide(path, benchmark.silence_bytes())
+
+
+def make_level(directory, name):
+    """A floor with a coin, a rat and a gate on it, and both layers full of tiles."""
+    image = Image.new('RGB', (WIDTH, HEIGHT), (255, 255, 255))
+    pixel = image.load()
+    for i in range(WIDTH):
+        pixel[i, HEIGHT - 1] = (0, 0, 0)
+    pixel[2, HEIGHT - 2] = (255, 216, 0)
+    pixel[5, HEIGHT - 2] = (128, 64, 0)
+    pixel[8, HEIGHT - 4] = (128, 0, 255)
+    path = os.path.join(str(directory), name)
+    image.save(path)
+    for layer in ('background', 'foreground'):
+        os.makedirs(os.path.join(str(directory), layer), exist_ok=True)
+        Image.new('RGBA', (WIDTH, HEIGHT), TILE).save(os.path.join(str(directory), layer, name))
+    return path
+
+
+def spawned(level, kind):
+    return [entity for (spawn, pos, data), entity in zip(level.spawns, level.spawned) if spawn == kind]
+
+
+def test_evicted_level_keeps_its_changes(tmp_path, headless):
+    names = [make_level(tmp_path, 'level_%d.png' % n) for n in range(2)]
+    player = run.Player((run.TILE_SIZE, run.TILE_SIZE))
+    cache = run.LevelCache(names, player, budget=1)
+    level = cache.get(0)
+    coin, = spawned(level, 'coin')
+    rat, = spawned(level, 'rat')
+    gate, = spawned(level, 'gate')
+    coin.kill()
+    rat.kill()
+    # what Gate.unlock does, without the cutscene
+    gate.locked = False
+    level.objects.remove(gate)
+
+    cache.get(1)
+    assert list(cache.levels) == [1]
+    level = cache.get(0)
+    assert list(cache.levels) == [0]
+    assert spawned(level, 'coin') == [None]
+    assert spawned(level, 'rat') == [None]
+    assert not level.items and not level.enemies
+    gate, = spawned(level, 'gate')
+    assert not gate.locked and gate.open
+    assert gate.alive() and gate not in level.objects
+
+
+def test_preloaded_layers_are_counted_and_evicted(tmp_path, headless):
+    names = [make_level(tmp_path, 'level_%d.png' % n) for n in range(3)]
+    player = run.Player((run.TILE_SIZE, run.TILE_SIZE))
+    cache = run.LevelCache(names, player)
+    level = cache.get(0)
+    cache.preload(1)
+    assert cache.memory() == level.memory() * 2
+    cache.build_pending(seconds=10)
+    assert not cache.pending
+
+    cache = run.LevelCache(names, player, budget=1)
+    cache.get(0)
+    cache.preload(1)
+    cache.preload(2)
+    # the level being played and the layers asked for last stay
+    assert list(cache.levels) == [0]
+    assert list(cache.layers) == [2] and cache.pending == [2]
+    cache.preload(2)
+    assert list(cache.layers) == [2]
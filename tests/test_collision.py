@@ -0,0 +1,52 @@
+import os
+import sys
+import random
+
+import pytest
+
+pygame = pytest.importorskip('pygame')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run  # noqa: E402
+
+
+def random_grid(width, height, seed):
+    rnd = random.Random(seed)
+    grid = run.CollisionGrid(width, height)
+    for y in range(height):
+        for x in range(width):
+            grid.set(x, y, rnd.choice((run.EMPTY, run.EMPTY, run.SOLID, run.SOLID, run.UPPER)))
+    # a floor and a ledge that merge into long runs
+    for x in range(width):
+        grid.set(x, height - 1, run.SOLID)
+        grid.set(x, 0, run.UPPER)
+    return grid
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_covers_exactly_the_solid_tiles(seed):
+    grid = random_grid(23, 17, seed)
+    covered = bytearray(len(grid.tiles))
+    for x, y, w, h, value in grid.merge():
+        assert value in (run.SOLID, run.UPPER)
+        if value == run.UPPER:
+            assert h == 1
+        for j in range(y, y + h):
+            for i in range(x, x + w):
+                assert grid.get(i, j) == value
+                assert not covered[j * grid.width + i]
+                covered[j * grid.width + i] = 1
+    assert covered == bytearray(1 if value else 0 for value in grid.tiles)
+
+
+def test_merge_joins_runs():
+    grid = run.CollisionGrid(4, 3)
+    for x in range(4):
+        for y in range(3):
+            grid.set(x, y, run.SOLID)
+    assert grid.merge() == [(0, 0, 4, 3, run.SOLID)]
+    grid = run.CollisionGrid(3, 2)
+    for x in range(3):
+        for y in range(2):
+            grid.set(x, y, run.UPPER)
+    assert grid.merge() == [(0, 0, 3, 1, run.UPPER), (0, 1, 3, 1, run.UPPER)]
@@ -0,0 +1,165 @@
+import os
+import sys
+
+import pytest
+
+pygame = pytest.importorskip('pygame')
+from PIL import Image  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run  # noqa: E402
+import benchmark  # noqa: E402
+
+WIDTH, HEIGHT = 10, 6
+TILE = next(color for color in run.TILE_DICT if len(color) == 4)
+
+
+def make_level(directory, name='level_test.png'):
+    """A small level with a floor, a ledge, a coin, a rat and a door, and both layers."""
+    image = Image.new('RGB', (WIDTH, HEIGHT), (255, 255, 255))
+    pixel = image.load()
+    for i in range(WIDTH):
+        pixel[i, HEIGHT - 1] = (0, 0, 0)
+    for i in range(3, 6):
+        pixel[i, 2] = (20, 20, 20)
+    pixel[1, 4] = (255, 216, 0)
+    pixel[7, 4] = (128, 64, 0)
+    pixel[4, 1] = (3, 248, 5)
+    path = os.path.join(str(directory), name)
+    image.save(path)
+    for layer in ('background', 'foreground'):
+        os.makedirs(os.path.join(str(directory), layer), exist_ok=True)
+        image = Image.new('RGBA', (WIDTH, HEIGHT), (0, 0, 0, 0))
+        pixel = image.load()
+        for i in range(WIDTH):
+            pixel[i, HEIGHT - 1 if layer == 'foreground' else 0] = TILE
+        image.save(os.path.join(str(directory), layer, name))
+    return path
+
+
+def same(a, b):
+    assert (a.width, a.height) == (b.width, b.height)
+    assert a.grid == b.grid
+    assert a.spawns == b.spawns
+    for x, y in ((a.background, b.background), (a.foreground, b.foreground)):
+        assert (x.width, x.height, x.tiles) == (y.width, y.height, y.tiles)
+
+
+@pytest.fixture(scope='module')
+def headless():
+    """A dummy display and generated tile images, for rendering layers."""
+    benchmark.init_headless()
+    benchmark.provide_resources()
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """Counts the calls to parse_level."""
+    calls = []
+    parse_level = run.parse_level
+
+    def counting(level):
+        calls.append(level)
+        return parse_level(level)
+    monkeypatch.setattr(run, 'parse_level', counting)
+    return calls
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_parse_level(tmp_path, monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(run, 'numpy', None)
+    elif run.numpy is None:
+        pytest.skip('numpy is not installed')
+    data = run.parse_level(make_level(tmp_path))
+    assert data.grid[(HEIGHT - 1) * WIDTH] == run.SOLID
+    assert data.grid[2 * WIDTH + 4] == run.UPPER
+    assert data.spawns == [('coin', (1, 4), None), ('door', (4, 1), (3, 5)), ('rat', (7, 4), None)]
+    assert data.foreground.tiles[(HEIGHT - 1) * WIDTH] == run.TILE_INDEX[TILE]
+
+
+def test_round_trip(tmp_path):
+    level = make_level(tmp_path)
+    data = run.parse_level(level)
+    stamps = [run.source_stamp(source, checksum=True) for source in run.level_sources(level)]
+    path = str(tmp_path / 'level_test.lvl')
+    run.write_level(path, data, stamps)
+    assert run.read_level_stamps(path) == stamps
+    same(run.read_level(path), data)
+
+
+def test_load_level_compiles_once(tmp_path, parses):
+    level = make_level(tmp_path)
+    first = run.load_level(level)
+    assert os.path.isfile(run.compiled_path(level))
+    same(run.load_level(level), first)
+    assert len(parses) == 1
+
+
+def test_touched_source_only_rewrites_stamps(tmp_path, parses):
+    level = make_level(tmp_path)
+    data = run.load_level(level)
+    stat = os.stat(level)
+    os.utime(level, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    same(run.load_level(level), data)
+    assert len(parses) == 1
+    stamps = run.read_level_stamps(run.compiled_path(level))
+    assert stamps[0][0] == stat.st_mtime_ns + 10 ** 9
+
+
+def test_changed_source_is_parsed_again(tmp_path, parses):
+    level = make_level(tmp_path)
+    run.load_level(level)
+    image = Image.open(level)
+    image.load()
+    image.putpixel((0, 0), (0, 0, 0))
+    image.save(level)
+    data = run.load_level(level)
+    assert len(parses) == 2
+    assert data.grid[0] == run.SOLID
+    same(run.load_level(level), data)
+    assert len(parses) == 2
+
+
+@pytest.mark.parametrize('keep', [run.LEVEL_HEADER_SIZE + 10, -20])
+def test_truncated_compile_is_parsed_again(tmp_path, parses, keep):
+    level = make_level(tmp_path)
+    data = run.load_level(level)
+    path = run.compiled_path(level)
+    with open(path, 'rb') as f:
+        contents = f.read()
+    with open(path, 'wb') as f:
+        f.write(contents[:keep])
+    same(run.load_level(level), data)
+    assert len(parses) == 2
+    with open(path, 'rb') as f:
+        assert len(f.read()) == len(contents)
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_other_colour_tables_are_stale(tmp_path, monkeypatch):
+    level = make_level(tmp_path)
+    run.load_level(level)
+    path = run.compiled_path(level)
+    assert run.read_level_stamps(path) is not None
+    monkeypatch.setattr(run, 'LEVEL_TABLE_CRC', run.LEVEL_TABLE_CRC ^ 1)
+    assert run.read_level_stamps(path) is None
+
+
+def test_render_cache(tmp_path, headless):
+    layer = run.read_layer(os.path.join(os.path.dirname(make_level(tmp_path)), 'foreground', 'level_test.png'))
+    cache = str(tmp_path / 'cache')
+    rendered = run.render_layer(layer, cache)
+    files = os.listdir(cache)
+    assert len(files) == 1 and files[0].startswith('layer_') and files[0].endswith('.png')
+    path = os.path.join(cache, files[0])
+    cached = run.render_layer(layer, cache)
+    assert cached.get_size() == rendered.get_size()
+    assert pygame.image.tobytes(cached, 'RGBA') == pygame.image.tobytes(rendered, 'RGBA')
+    # a damaged image is a miss that gets rendered and saved again
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG broken')
+    again = run.render_layer(layer, cache)
+    assert pygame.image.tobytes(again, 'RGBA') == pygame.image.tobytes(rendered, 'RGBA')
+    assert os.listdir(cache) == files
+    assert os.path.getsize(path) > 16
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+pygame = pytest.importorskip('pygame')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run  # noqa: E402
+
+# the game loads its assets relative to the working directory
+pytestmark = pytest.mark.skipif(not os.path.isdir('resources'),
+                                reason="run from a directory with the game's resources")
+
+TICKS = 300
+SEED = 1234
+
+
+class ScriptedInput(object):
+    """Walks right, jumping and attacking every so often."""
+    finished = False
+
+    def __init__(self):
+        self.step = 0
+
+    def poll(self, events):
+        self.step += 1
+        keys = run.INPUT_BITS[run.K_d]
+        if self.step % 40 < 10:
+            keys |= run.INPUT_BITS[run.K_w]
+        if self.step % 25 == 0:
+            keys |= run.INPUT_BITS[run.K_SPACE]
+        return run.InputFrame(keys)
+
+
+def steps():
+    return round(run.sim_clock.time / run.TIMESTEP)
+
+
+def test_replay_matches_recording(tmp_path):
+    game = run.create_game(headless=True, start_state="GAMEPLAY", seed=SEED)
+    game.input = run.InputRecorder(ScriptedInput(), SEED, "GAMEPLAY")
+    game.step(TICKS)
+    assert steps() == TICKS
+    recorded = game.states["GAMEPLAY"].checksum()
+    path = str(tmp_path / 'scripted.rpl')
+    game.input.save(path)
+
+    replay = run.InputReplay(path)
+    assert len(replay.frames) == TICKS
+    game = run.create_game(headless=True, start_state=replay.start_state, seed=replay.seed)
+    game.input = replay
+    # one step more than recorded, which only ends the replay
+    game.step(TICKS + 1)
+    assert game.done
+    assert steps() == TICKS
+    assert game.states["GAMEPLAY"].checksum() == recorded